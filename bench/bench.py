@@ -0,0 +1,333 @@
+# File:         bench.py
+# Author:       Brian Allen Vanderburg II
+# Purpose:      Generate a synthetic site and time building it
+# License:      Refer to the file license.txt
+
+import sys
+import os
+import time
+import json
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+
+LIBDIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+CONFIG = """<?xml version="1.0" encoding="utf-8"?>
+<xmlsite>
+    <property name="highlight.classes" value="yes" />
+    <builder name="main" strip="yes">
+        <match ending=".xml" />
+        <exclude pattern="^shared/" />
+        <param name="sitename" value="Benchmark" />
+        <transform root="page" xsl="site.xsl">
+            <state entry="/page/entry" year="@year" month="@month" day="@day" title="@title" summary="summary/text()" tag="tag/@name" />
+        </transform>
+        <header>&lt;!-- @sourcerpath@ --&gt;</header>
+        <footer src="footer.txt" />
+        <emptytag tag="br" />
+        <emptytag tag="hr" />
+        <preservetag tag="pre" />
+    </builder>
+</xmlsite>
+"""
+
+STYLESHEET = """<?xml version="1.0" encoding="UTF-8"?>
+<xsl:stylesheet version="1.0"
+    xmlns:xsl="http://www.w3.org/1999/XSL/Transform"
+    xmlns:mrbavii="urn:mrbavii:xmlsite"
+    xmlns="http://www.w3.org/1999/xhtml"
+    exclude-result-prefixes="mrbavii">
+
+    <xsl:output indent="yes" method="xml" omit-xml-declaration="yes" encoding="utf-8" />
+
+    <xsl:param name="sitename" />
+    <xsl:param name="relativeroot" />
+    <xsl:param name="highlight" select="'no'" />
+
+    <xsl:template match="/page">
+        <html>
+        <head><title><xsl:value-of select="@title" /> - <xsl:value-of select="$sitename" /></title></head>
+        <body>
+        <xsl:apply-templates />
+        </body>
+        </html>
+    </xsl:template>
+
+    <xsl:template match="fragment">
+        <div class="fragment">
+            <a href="{$relativeroot}{mrbavii:rbase-uri()}"><xsl:value-of select="@name" /></a>
+            <xsl:apply-templates />
+        </div>
+    </xsl:template>
+
+    <xsl:template match="entry">
+        <div class="entry">
+            <h2><xsl:value-of select="@title" /></h2>
+            <p><xsl:value-of select="summary" /></p>
+            <xsl:for-each select="tag"><span class="tag"><xsl:value-of select="@name" /></span></xsl:for-each>
+            <hr />
+        </div>
+    </xsl:template>
+
+    <xsl:template match="code">
+        <xsl:choose>
+            <xsl:when test="$highlight = 'yes'">
+                <xsl:value-of select="mrbavii:highlight_code(string(.), string(@syntax))" disable-output-escaping="yes" />
+            </xsl:when>
+            <xsl:otherwise>
+                <pre><xsl:value-of select="." /></pre>
+            </xsl:otherwise>
+        </xsl:choose>
+    </xsl:template>
+
+    <xsl:template match="para">
+        <p><xsl:apply-templates /><br /></p>
+    </xsl:template>
+
+    <xsl:template match="summary" />
+    <xsl:template match="tag" />
+
+</xsl:stylesheet>
+"""
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor '
+         'incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud').split()
+
+CODE = '''def function_{0}(value):
+    # Comment {0}
+    result = [i * {0} for i in range(value)]
+    if len(result) > {0}:
+        return sum(result)
+    return None
+'''
+
+
+class Site(object):
+    def __init__(self, opts, root):
+        self.opts = opts
+        self.root = root
+        self.indir = os.path.join(root, 'input')
+        self.random = random.Random(opts.seed)
+        self.pages = []
+
+    def words(self, count):
+        return ' '.join(self.random.choice(WORDS) for i in range(count))
+
+    def pagepath(self, index):
+        # Spread the pages over nested directories
+        parts = []
+        value = index
+        for level in range(self.opts.depth):
+            parts.append('d{0}'.format(value % self.opts.width))
+            value //= self.opts.width
+
+        parts.append('page{0}.xml'.format(index))
+        return os.path.join(*parts)
+
+    def generate(self):
+        os.makedirs(self.indir)
+
+        with open(os.path.join(self.root, 'config.xml'), 'wb') as handle:
+            handle.write(CONFIG)
+        with open(os.path.join(self.root, 'site.xsl'), 'wb') as handle:
+            handle.write(STYLESHEET)
+        with open(os.path.join(self.root, 'footer.txt'), 'wb') as handle:
+            handle.write('<!-- benchmark -->\n')
+
+        # Shared fragments pulled in by xinclude
+        shared = os.path.join(self.indir, 'shared')
+        os.makedirs(shared)
+        for i in range(self.opts.shared):
+            with open(os.path.join(shared, 'frag{0}.xml'.format(i)), 'wb') as handle:
+                handle.write('<fragment name="frag{0}"><para>{1}</para></fragment>\n'.format(i, self.words(40)))
+
+        for i in range(self.opts.pages):
+            relpath = self.pagepath(i)
+            self.pages.append(relpath)
+            self.writepage(i, relpath)
+
+    def writepage(self, index, relpath, day=None):
+        filename = os.path.join(self.indir, relpath)
+        dirname = os.path.dirname(filename)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        up = '../' * relpath.count(os.sep)
+        rand = random.Random(self.opts.seed * 1000003 + index)
+
+        lines = ['<?xml version="1.0" encoding="utf-8"?>',
+                 '<page xmlns:xi="http://www.w3.org/2001/XInclude" title="Page {0}">'.format(index)]
+
+        for j in range(self.opts.fanout):
+            frag = (index + j) % self.opts.shared
+            lines.append('<xi:include href="{0}shared/frag{1}.xml" />'.format(up, frag))
+
+        for j in range(self.opts.entries):
+            if day is None:
+                entryday = rand.randint(1, 28)
+            else:
+                entryday = day
+            lines.append('<entry year="{0}" month="{1}" day="{2}" title="Entry {3}.{4}">'.format(
+                rand.randint(2000, 2020), rand.randint(1, 12), entryday, index, j))
+            lines.append('<summary>{0}</summary>'.format(' '.join(rand.choice(WORDS) for k in range(12))))
+            for k in range(min(3, self.opts.tags)):
+                lines.append('<tag name="tag{0}" />'.format(rand.randint(0, self.opts.tags - 1)))
+            lines.append('</entry>')
+
+        for j in range(self.opts.paragraphs):
+            lines.append('<para>{0}</para>'.format(' '.join(rand.choice(WORDS) for k in range(60))))
+
+        for j in range(self.opts.codeblocks):
+            lines.append('<code syntax="python">{0}</code>'.format(CODE.format(index * 100 + j)))
+
+        lines.append('</page>')
+
+        with open(filename, 'wb') as handle:
+            handle.write('\n'.join(lines) + '\n')
+
+
+def build(opts, site, name):
+    outdir = os.path.join(site.root, 'output')
+    report = os.path.join(site.root, 'profile-{0}.json'.format(name))
+
+    command = [sys.executable, '-B', '-m', 'xmlsite.main',
+               '--config', os.path.join(site.root, 'config.xml'),
+               '--builder', 'main',
+               '--input-dir', site.indir,
+               '--output-dir', outdir,
+               '--state-dir', os.path.join(outdir, 'state'),
+               '--jobs', str(opts.jobs),
+               '--profile', report,
+               'highlight=' + ('yes' if opts.highlight else 'no')]
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = LIBDIR + os.pathsep + env.get('PYTHONPATH', '')
+
+    with open(os.devnull, 'wb') as devnull:
+        start = time.time()
+        subprocess.check_call(command, env=env, stderr=devnull)
+        elapsed = time.time() - start
+
+    with open(report, 'rb') as handle:
+        profile = json.load(handle)
+
+    return {
+        'wall': elapsed,
+        'build': profile['elapsed'],
+        'state': profile['other'].get('state', 0.0),
+        'statuses': profile['statuses']
+    }
+
+
+def scenarios(opts, site):
+    outdir = os.path.join(site.root, 'output')
+    middle = len(site.pages) // 2
+
+    def cold():
+        if os.path.isdir(outdir):
+            shutil.rmtree(outdir)
+        return build(opts, site, 'cold')
+
+    def noop():
+        return build(opts, site, 'noop')
+
+    def edit():
+        # Change the text of one page but none of its state
+        filename = os.path.join(site.indir, site.pages[middle])
+        with open(filename, 'ab') as handle:
+            handle.write('\n')
+        return build(opts, site, 'edit')
+
+    def state():
+        # Change the dates of one page so the state order shifts
+        site.writepage(middle, site.pages[middle], day=28 if opts.seed % 2 else 1)
+        opts.seed += 1
+        return build(opts, site, 'state')
+
+    return [('cold', cold), ('noop', noop), ('edit', edit), ('state', state)]
+
+
+def summarize(runs):
+    result = {}
+    for key in ('wall', 'build', 'state'):
+        values = sorted(run[key] for run in runs)
+        result[key] = {
+            'min': values[0],
+            'median': values[len(values) // 2],
+            'max': values[-1]
+        }
+
+    result['statuses'] = runs[-1]['statuses']
+    return result
+
+
+def parse_cmdline():
+    parser = argparse.ArgumentParser(description='Benchmark building a synthetic site.')
+    parser.add_argument('--pages', dest='pages', type=int, default=500, help='number of pages')
+    parser.add_argument('--depth', dest='depth', type=int, default=2, help='directory nesting depth')
+    parser.add_argument('--width', dest='width', type=int, default=8, help='directories at each level')
+    parser.add_argument('--shared', dest='shared', type=int, default=20, help='number of shared fragments')
+    parser.add_argument('--fanout', dest='fanout', type=int, default=3, help='fragments xincluded by each page')
+    parser.add_argument('--paragraphs', dest='paragraphs', type=int, default=10, help='paragraphs per page')
+    parser.add_argument('--code-blocks', dest='codeblocks', type=int, default=2, help='code blocks per page')
+    parser.add_argument('--highlight', dest='highlight', action='store_true', default=False, help='highlight code blocks with pygments')
+    parser.add_argument('--entries', dest='entries', type=int, default=1, help='state entries per page')
+    parser.add_argument('--tags', dest='tags', type=int, default=20, help='number of distinct tags')
+    parser.add_argument('--jobs', dest='jobs', type=int, default=1, help='pages to build in parallel')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=3, help='times to run each scenario')
+    parser.add_argument('--seed', dest='seed', type=int, default=1, help='random seed for the generated site')
+    parser.add_argument('--work-dir', dest='workdir', help='where to generate the site (default: a temporary directory)')
+    parser.add_argument('--output', dest='output', help='write the JSON results to this file instead of stdout')
+
+    return parser.parse_args()
+
+
+def main():
+    opts = parse_cmdline()
+
+    workdir = opts.workdir or tempfile.mkdtemp(prefix='xmlsite-bench-')
+    root = os.path.join(workdir, 'site')
+    if os.path.isdir(root):
+        shutil.rmtree(root)
+
+    try:
+        params = dict(vars(opts))
+        site = Site(opts, root)
+        site.generate()
+
+        results = {}
+        for (name, func) in scenarios(opts, site):
+            runs = []
+            for i in range(opts.repeat):
+                sys.stderr.write('Running: {0} ({1}/{2})\n'.format(name, i + 1, opts.repeat))
+                runs.append(func())
+            results[name] = summarize(runs)
+
+        # Include what is needed to tell whether two results are comparable
+        import lxml.etree
+        output = {
+            'parameters': params,
+            'python': platform.python_version(),
+            'lxml': lxml.etree.__version__,
+            'platform': platform.platform(),
+            'results': results
+        }
+
+        text = json.dumps(output, indent=2, sort_keys=True) + '\n'
+        if opts.output:
+            with open(opts.output, 'wb') as handle:
+                handle.write(text)
+        else:
+            sys.stdout.write(text)
+    finally:
+        if not opts.workdir:
+            shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,24 +7,91 @@ import sys
 import os
 import re
 import codecs
+import json
+import hashlib
 import cStringIO
+import cPickle
+import time
+import collections
+import multiprocessing
+import urllib
+from copy import deepcopy
 
 from lxml import etree
 
 from . import util
-from .state import StateParser
+from . import manifest
+from . import profiler
+from . import setup
+from . import compress
+from .state import StateParser, _State
+
+
+# A page found while scanning the input
+class _Page(object):
+    def __init__(self, relpath, sourcefile, reldest, targetfile):
+        self.relpath = relpath
+        self.sourcefile = sourcefile
+        self.reldest = reldest
+        self.targetfile = targetfile
+        self.params = None
+        self.phash = None
+        self.record = None
+        self.output = None
+
+
+# Worker process support for parallel builds
+_worker = None
+
+def _initworker(builder):
+    global _worker
+    _worker = builder
+    setup.setup(builder.config)
+
+def _process(page):
+    try:
+        return _worker.buildpage(page)
+    except etree.Error as e:
+        # lxml errors do not survive the trip back to the parent
+        raise util.Error(util.errortext(e).rstrip('\n'))
 
 
 class Builder(object):
     def __init__(self, config, xml):
         self.config = config
         self.statens = '{urn:mrbavii:xmlsite.state}'
+        self.manifest = None
+
+        # Input directories unchanged since the last walk and the stamps
+        # of other files already checked during this build
+        self.trusted = set()
+        self.stamped = {}
+
+        # Sources linked into the output by this and the last build and
+        # the output directories known to exist
+        self.links = set()
+        self.oldlinks = set()
+        self.linkdirs = set()
+
+        # The part of the input built when the build is split across
+        # machines, as (index, count), and where each source was found
+        self.shard = getattr(config.opts, 'shard', None)
+        self.order = {}
+
+        # Files other than the sources that affect every target
+        self.files = [self.config.filename]
 
         # Basic stuff
+        self.name = xml.get('name')
         self.extension = xml.get('extension', '.html')
         self.encoding = xml.get('encoding', 'utf-8')
         self.strip = util.getbool(xml.get('strip', 'no'))
         self.link = util.getbool(xml.get('link', 'no'))
+        self.prune = util.getbool(xml.get('prune', 'no'))
+
+        # Compressed copies of changed output, made in the background
+        self.compresslevel = compress.level(xml.get('compress'))
+        self.compressor = None
 
         # Includes
         self.includes = []
@@ -40,10 +107,19 @@ class Builder(object):
             if pattern:
                 self.excludes.append(pattern)
 
-        # Matching extensions
+        self.included = util.searcher(self.includes)
+        self.excluded = util.searcher(self.excludes)
+
+        # A pattern that matches a directory as 'dir/' matches everything
+        # in it only if the match can't depend on what follows, so the walk
+        # skips directories with those patterns alone
+        self.excludeddirs = util.searcher([i for i in self.excludes if not self.lookaround.search(i)])
+
+        # Matching extensions, the last one that matches is used
         self.matches = []
         for i in xml.findall('match'):
             self.matches.append(i.get('ending'))
+        self.endings = list(reversed(self.matches))
 
         # Parameters
         self.params = {}
@@ -63,6 +139,12 @@ class Builder(object):
             if state is not None:
                 self.states[root] = StateParser.load(self.config, state)
 
+        # Roots with only a state, whose entries can be read while parsing
+        self.streamable = {}
+        for root in self.states:
+            if self.transforms[root] is None and self.states[root].steps is not None:
+                self.streamable[root] = self.states[root]
+
         # Header and footer
         def loader(elem):
             result = ''
@@ -70,7 +152,9 @@ class Builder(object):
                 src = elem.get('src')
                 if src is not None:
                     enc = elem.get('encoding', 'utf-8')
-                    result = codecs.open(self.config.path(src), 'rU', encoding=enc).read()
+                    path = self.config.path(src)
+                    result = codecs.open(path, 'rU', encoding=enc).read()
+                    self.files.append(path)
                 else:
                     result = elem.text
 
@@ -94,6 +178,27 @@ class Builder(object):
         for i in xml.findall('find'):
             self.replacements.append((i.get('match'), i.get('replace')))
 
+        # Compile the output cleanup, the output can only be cleaned up in
+        # pieces when no replacement can match across lines or tags
+        self.chunked = not any(not find or any(c in find + replace for c in '<>\n') for (find, replace) in self.replacements)
+        self.stages = self.buildstages()
+        self.headerparts = self.template(self.header)
+        self.footerparts = self.template(self.footer)
+
+    # Lookarounds, end anchors and word boundaries look past a match
+    lookaround = re.compile(r'\(\?<?[=!]|\$|\\[ZbB]')
+
+    def __getstate__(self):
+        # The compiled cleanup stages are rebuilt rather than pickled
+        state = self.__dict__.copy()
+        del state['stages']
+        state['compressor'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.stages = self.buildstages()
+
     def _getroot(self, root):
         parts = root.split(':', 1)
 
@@ -112,110 +217,668 @@ class Builder(object):
     def load(config, xml):
         return Builder(config, xml)
 
-    def execute(self):
+    def execute(self, changed=None):
+        self.begin(changed is None)
+
+        # Either build everything or just what depends on the changed files
+        if changed is None:
+            pages = self.scan()
+        else:
+            pages = self.affected(changed)
+
+        jobs = self.config.opts.jobs
+        if jobs > 1:
+            results = self.runparallel(pages, jobs)
+        else:
+            results = self.runserial(pages)
+
+        if self.compresslevel is not None:
+            results = self.sidecars(results)
+
+        if self.config.opts.profile:
+            report = profiler.Report(self.config.opts.profiletop)
+        else:
+            report = None
+
+        self.finish(changed, results, report)
+
+        if report is not None:
+            report.save(self.config.opts.profile)
+
+    def begin(self, full):
+        # The manifest remembers what each target was built from
+        if self.manifest is None:
+            self.manifest = manifest.Manifest(self.manifestname())
+
+        # Stylesheets are checked for changes again, and so is every other
+        # file, only a full walk can tell which directories are unchanged
+        self._verified.clear()
+        self.trusted = set()
+        self.stamped = {}
+
+        self.manifest.begin(full)
+        self.beginlinks(full)
+
+    def manifestname(self):
+        # Each shard remembers only its own files, so shards sharing a
+        # cache directory keep separate manifests
+        if self.shard is None:
+            return os.path.join(self.config.opts.cachedir, self.name + '.manifest')
+
+        return os.path.join(self.config.opts.cachedir, '{0}.shard-{1}-of-{2}.manifest'.format(self.name, *self.shard))
+
+    def finish(self, changed, results, report=None, state=True):
+        (count, written) = (0, 0)
+        for (relpath, status, record, timings) in results:
+            if record is not None:
+                self.manifest.set(relpath, record)
+            if report is not None:
+                report.add(relpath, status, timings)
+            if status == 'OK':
+                written += 1
+            count += 1
+
+        if count:
+            util.log('Targets written: {0} of {1}'.format(written, count))
+
+        # Links whose sources were not seen, other shards look after theirs
+        if changed is None:
+            for relpath in sorted(self.oldlinks - self.links):
+                if self.inshard(relpath):
+                    self.unlink(relpath)
+
+        # Nothing was built or removed
+        if changed is not None and count == 0 and len(self.manifest.entries) == len(self.manifest.previous):
+            self.waitsidecars()
+            return
+
+        # Finally, build the states, a shard only dumps its own
+        start = time.time()
+        if state:
+            states = []
+            for (relpath, record) in self.manifest.items():
+                states.extend([(relpath, i) for i in record['states']])
+
+            if self.shard is None:
+                self.savestate(states)
+            else:
+                self.dumpstate(states)
+        self.waitsidecars()
+        self.manifest.save()
+
+        if report is not None:
+            report.record('state', time.time() - start)
+
+    def getcompressor(self):
+        # Threads are started in the process that uses them
+        if self.compressor is None:
+            self.compressor = compress.Compressor(self.compresslevel)
+        return self.compressor
+
+    def sidecars(self, results):
+        # Compress targets as their results come in, while the next pages build
+        for result in results:
+            self.sidecar(result)
+            yield result
+
+    def sidecar(self, result):
+        (relpath, status, record, timings) = result
+        if record is None:
+            return
+
+        targetfile = os.path.join(self.config.opts.outdir, record['target'])
+        if not record['built']:
+            self.getcompressor().remove(targetfile)
+        elif status == 'OK' or not os.path.isfile(compress.sidecar(targetfile)):
+            self.getcompressor().add(targetfile)
+
+    def waitsidecars(self):
+        if self.compressor is not None:
+            (compressor, self.compressor) = (self.compressor, None)
+            compressor.close()
+
+    def scan(self):
         sourceroot = self.config.opts.indir
-        targetroot = self.config.opts.outdir
 
-        states = []
-        for (dir, dirs, files) in os.walk(sourceroot):
-            for f in files:
-                relpath = os.path.relpath(os.path.join(dir, f), sourceroot)
-                sourcefile = os.path.join(sourceroot, relpath)
-                compare = relpath.replace(os.sep, '/')
+        (snapshot, current) = self.beginsnapshot()
+        self.order = {}
+
+        for (reldir, files, trusted) in self.walk(sourceroot, snapshot, current, self.excludeddirs):
+            if trusted:
+                self.trusted.add(os.path.normpath(os.path.join(sourceroot, reldir)))
 
-                # Includes
-                found = any([re.search(i, compare) for i in self.includes])
-                if not found and len(self.includes) > 0:
+            for f in files:
+                relpath = os.path.join(reldir, f)
+                if not self.walked(relpath):
                     continue
 
-                # Excludes
-                if any([re.search(i, compare) for i in self.excludes]):
+                page = self.select(relpath, trusted)
+                if page is not None:
+                    yield page
+
+    def walked(self, relpath):
+        # Each file is numbered in walk order so the states of all the
+        # shards can be put back in the order a single build sees them,
+        # returns whether the file is in this shard
+        if self.shard is not None:
+            self.order[relpath] = len(self.order)
+
+        return self.inshard(relpath)
+
+    def inshard(self, relpath):
+        # Files are split by a hash of their path, the same on every machine
+        if self.shard is None:
+            return True
+
+        (index, count) = self.shard
+        key = hashlib.md5(relpath.replace(os.sep, '/')).hexdigest()
+        return int(key[:8], 16) % count == index - 1
+
+    def beginsnapshot(self):
+        # Listings of the last walk are only used if directory times are trusted,
+        # returns the last snapshot and the one to fill during this walk
+        sourceroot = self.config.opts.indir
+        if not self.config.opts.trustdirs:
+            self.manifest.extra.pop('snapshot', None)
+            return (None, None)
+
+        snapshot = self.manifest.extra.get('snapshot')
+        if snapshot is not None and snapshot['root'] != sourceroot:
+            snapshot = None
+
+        current = { 'root': sourceroot, 'time': time.time(), 'dirs': {} }
+        self.manifest.extra['snapshot'] = current
+        return (snapshot, current)
+
+    @staticmethod
+    def walk(sourceroot, snapshot=None, current=None, excluded=None):
+        # Visits directories in the same order as os.walk
+        pending = ['']
+        while pending:
+            reldir = pending.pop()
+            dir = os.path.join(sourceroot, reldir)
+
+            (listing, trusted) = (None, False)
+            if current is not None:
+                try:
+                    mtime = os.stat(dir).st_mtime
+                except OSError:
                     continue
 
-                # Link first if desired
-                if self.link:
-                    linkfile = os.path.join(targetroot, relpath)
-                    linkdir = os.path.dirname(linkfile)
-
-                    # Don't overwrite/remove if the link is the source
-                    if sourcefile != linkfile:
-                        if not os.path.isdir(linkdir):
-                            os.makedirs(linkdir)
-                        elif os.path.exists(linkfile):
-                            os.unlink(linkfile)
-
-                        link = os.path.relpath(sourcefile, linkdir)
-                        os.symlink(link, linkfile)
-
-                # Matches used for building
-                found = False
-                for i in self.matches:
-                    if relpath.endswith(i) or len(i) == 0:
-                        found = True
-                        ending = i
-
-                if not found:
+                # A directory changed just before the last walk may have
+                # changed again within the same timestamp
+                if snapshot is not None and reldir in snapshot['dirs']:
+                    entry = snapshot['dirs'][reldir]
+                    if entry[0] == mtime and mtime < snapshot['time'] - 2:
+                        (listing, trusted) = (entry[1:], True)
+
+            if listing is None:
+                try:
+                    names = os.listdir(dir)
+                except OSError:
                     continue
 
-                # Do it
-                util.message('Transforming: ' + relpath)
+                (dirs, files) = ([], [])
+                for name in names:
+                    path = os.path.join(dir, name)
+                    if os.path.isdir(path):
+                        # Like os.walk, linked directories are not followed
+                        if not os.path.islink(path):
+                            dirs.append(name)
+                    else:
+                        files.append(name)
 
-                reldest = relpath[:-len(ending)] + self.extension
-                targetfile = os.path.join(targetroot, reldest)
+                listing = (dirs, files)
 
-                if sourcefile == targetfile:
-                    util.status('SAME')
-                    continue
+            if current is not None:
+                current['dirs'][reldir] = (mtime,) + listing
 
-                # Only parse the file once
-                inxml = etree.parse(sourcefile)
-                inxml.xinclude()
+            (dirs, files) = listing
+            yield (reldir, files, trusted)
 
-                # Parse the state
-                state = self.buildstate(inxml)
-                if state:
-                    states.extend([(relpath, i) for i in state])
+            # Don't descend into excluded directories
+            if excluded:
+                compare = reldir.replace(os.sep, '/')
+                compare = compare + '/' if compare else ''
+                dirs = [i for i in dirs if not excluded(compare + i + '/')]
 
-                # Is the page out of date?
-                if os.path.isfile(targetfile):
-                    stime = os.stat(sourcefile).st_mtime
-                    ttime = os.stat(targetfile).st_mtime
+            pending.extend(os.path.join(reldir, i) for i in reversed(dirs))
 
-                    if stime < ttime:
-                        util.status('NC')
-                        continue
+    def affected(self, changed):
+        sourceroot = self.config.opts.indir
 
-                    os.unlink(targetfile)
-
-                # Parameters
-                sourcedir = os.path.dirname(sourcefile)
-                targetdir = os.path.dirname(targetfile)
-
-                coreparams = {
-                    'sourceroot': sourceroot.replace(os.sep, '/').rstrip('/') + '/',
-                    'targetroot': targetroot.replace(os.sep, '/').rstrip('/') + '/',
-                    'sourcedir': sourcedir.replace(os.sep, '/').rstrip('/') + '/',
-                    'targetdir': targetdir.replace(os.sep, '/').rstrip('/') + '/',
-                    'sourcefile': sourcefile.replace(os.sep, '/'),
-                    'targetfile': targetfile.replace(os.sep, '/'),
-                    'sourcerpath': relpath.replace(os.sep, '/'),
-                    'targetrpath': reldest.replace(os.sep, '/'),
-                    'relativeroot':  '../' * relpath.count(os.sep)
-                }
-
-                bparams = self.params.copy()
-                bparams.update(self.config.opts.params)
-                bparams.update(coreparams)
-
-                # Build
-                if self.build(inxml, targetfile, bparams):
-                    util.status('OK')
-                else:
-                    util.status('IGN')
+        # Pages built from any of the changed files
+        relpaths = set()
+        for (relpath, record) in self.manifest.items():
+            for path in changed:
+                if path in record['sources'] or path in record['deps']:
+                    relpaths.add(relpath)
+                    break
+
+        # Changed files that are themselves sources
+        for path in changed:
+            relpath = os.path.relpath(path, sourceroot)
+            if not relpath.startswith(os.pardir + os.sep):
+                relpaths.add(relpath)
+
+        for relpath in sorted(relpaths):
+            if not os.path.isfile(os.path.join(sourceroot, relpath)):
+                self.manifest.remove(relpath)
+                if relpath in self.links:
+                    self.links.discard(relpath)
+                    self.unlink(relpath)
+                continue
+
+            page = self.select(relpath)
+            if page is not None:
+                yield page
+
+    def select(self, relpath, trusted=False):
+        if not self.selected(relpath):
+            return None
+
+        # Link first if desired
+        if self.link:
+            self.makelink(relpath, os.path.join(self.config.opts.indir, relpath), trusted)
+
+        return self.target(relpath)
+
+    def selected(self, relpath):
+        compare = relpath.replace(os.sep, '/')
 
+        # Includes
+        if self.included and not self.included(compare):
+            return False
 
-        # Finally, build the states
-        self.savestate(states)
+        # Excludes
+        if self.excluded and self.excluded(compare):
+            return False
+
+        return True
+
+    def target(self, relpath):
+        sourcefile = os.path.join(self.config.opts.indir, relpath)
+
+        # Matches used for building
+        for ending in self.endings:
+            if relpath.endswith(ending):
+                break
+        else:
+            return None
+
+        reldest = relpath[:-len(ending)] + self.extension
+        targetfile = os.path.join(self.config.opts.outdir, reldest)
+
+        return self.page(relpath, sourcefile, reldest, targetfile)
+
+    def beginlinks(self, full):
+        self.oldlinks = self.manifest.extra.get('links', set())
+        self.linkdirs = set()
+
+        if not self.link:
+            self.links = set()
+            self.manifest.extra.pop('links', None)
+        else:
+            self.links = set() if full else set(self.oldlinks)
+            self.manifest.extra['links'] = self.links
+
+    def makelink(self, relpath, sourcefile, trusted):
+        linkfile = os.path.join(self.config.opts.outdir, relpath)
+        linkdir = os.path.dirname(linkfile)
+
+        # Don't overwrite/remove if the link is the source
+        if sourcefile == linkfile:
+            return
+
+        # Links in trusted directories were checked last time
+        self.links.add(relpath)
+        if trusted and relpath in self.oldlinks:
+            return
+
+        if not linkdir in self.linkdirs:
+            util.makedirs(linkdir)
+            self.linkdirs.add(linkdir)
+
+        # Leave a link that is already correct alone
+        link = os.path.relpath(sourcefile, linkdir)
+        try:
+            if os.readlink(linkfile) == link:
+                return
+        except OSError:
+            pass
+
+        if os.path.lexists(linkfile):
+            os.unlink(linkfile)
+        os.symlink(link, linkfile)
+
+    def unlink(self, relpath):
+        # Only remove links, never files put there some other way
+        linkfile = os.path.join(self.config.opts.outdir, relpath)
+        if self.prune and os.path.islink(linkfile):
+            util.message('Removing link: ' + relpath)
+            os.unlink(linkfile)
+            util.status('OK')
+
+    def page(self, relpath, sourcefile, reldest, targetfile):
+        sourceroot = self.config.opts.indir
+        targetroot = self.config.opts.outdir
+
+        page = _Page(relpath, sourcefile, reldest, targetfile)
+        if sourcefile == targetfile:
+            return page
+
+        # Parameters
+        sourcedir = os.path.dirname(sourcefile)
+        targetdir = os.path.dirname(targetfile)
+
+        coreparams = {
+            'sourceroot': sourceroot.replace(os.sep, '/').rstrip('/') + '/',
+            'targetroot': targetroot.replace(os.sep, '/').rstrip('/') + '/',
+            'sourcedir': sourcedir.replace(os.sep, '/').rstrip('/') + '/',
+            'targetdir': targetdir.replace(os.sep, '/').rstrip('/') + '/',
+            'sourcefile': sourcefile.replace(os.sep, '/'),
+            'targetfile': targetfile.replace(os.sep, '/'),
+            'sourcerpath': relpath.replace(os.sep, '/'),
+            'targetrpath': reldest.replace(os.sep, '/'),
+            'relativeroot':  '../' * relpath.count(os.sep)
+        }
+
+        page.params = self.params.copy()
+        page.params.update(self.config.opts.params)
+        page.params.update(coreparams)
+        page.phash = manifest.paramhash(page.params)
+
+        # If the source and its xincludes are unchanged, so is its state
+        record = self.manifest.get(relpath) if self.manifest is not None else None
+        if record is not None and not self.changed(record['sources']):
+            page.record = record
+
+        # What was written last time, to avoid writing the same content again
+        if record is not None and record.get('digest'):
+            page.output = (record['digest'], record['output'])
+
+        return page
+
+    def check(self, page):
+        # Results that can be known without parsing the source
+        if page.sourcefile == page.targetfile:
+            return ('SAME', None, None)
+
+        record = page.record
+        if record is not None and self.uptodate(record, page.targetfile, page.phash):
+            return ('NC' if record['built'] else 'IGN', record, None)
+
+        return None
+
+    def process(self, page):
+        result = self.check(page)
+        if result is None:
+            result = self.buildpage(page)
+
+        return result
+
+    def buildpage(self, page):
+        # Time each phase of the build when profiling
+        if self.config.opts.profile:
+            profiler.begin()
+
+        try:
+            return self.buildpagephases(page)
+        finally:
+            profiler.end()
+
+    def buildpagephases(self, page):
+        if self.streamable:
+            states = self.streamstate(page.sourcefile, page.record is None)
+            if states is not None:
+                return self.buildparsed(page, None, set(), states)
+
+        (inxml, files) = self.parse(page.sourcefile)
+        return self.buildparsed(page, inxml, files)
+
+    def streamstate(self, sourcefile, extract=True):
+        # The states of a source with only a state, read without keeping
+        # the whole document, or None if the document must be parsed
+        with profiler.phase('state'):
+            with open(sourcefile, 'rb') as handle:
+                (event, root) = next(etree.iterparse(handle, events=('start',)))
+
+                parser = self.streamable.get(root.tag)
+                if parser is None:
+                    return None
+                if not extract or parser.steps[0] != root.tag:
+                    return []
+
+                handle.seek(0)
+                return parser.stream(handle)
+
+    def parse(self, sourcefile):
+        # Returns the document and the files loaded while parsing and
+        # xincluding it
+        recorder = manifest.Recorder()
+        parser = etree.XMLParser()
+        parser.resolvers.add(recorder)
+
+        # Only parse the file once
+        with profiler.phase('parse'):
+            inxml = etree.parse(sourcefile, parser)
+        with profiler.phase('xinclude'):
+            self.xinclude(inxml, recorder.files)
+
+        return (inxml, recorder.reset())
+
+    xincludetag = '{http://www.w3.org/2001/XInclude}include'
+
+    @classmethod
+    def xinclude(cls, inxml, files):
+        # Includes of whole documents are processed once per build and
+        # copied into each page, anything else is left to libxml2
+        # IDs are only registered with the document by libxml2 itself, and
+        # a document type may declare some for the included elements
+        if inxml.docinfo.doctype:
+            inxml.xinclude()
+            return
+
+        remaining = False
+        for elem in list(inxml.iter(cls.xincludetag)):
+            entry = cls.fragment(elem)
+            if entry is None or entry[0] is None:
+                remaining = True
+                continue
+
+            (nodes, stamps) = entry[:2]
+            files.update(stamps)
+
+            parent = elem.getparent()
+            index = parent.index(elem)
+            copies = [deepcopy(node) for node in nodes]
+            for (offset, node) in enumerate(copies):
+                parent.insert(index + offset, node)
+
+            if elem.tail:
+                copies[-1].tail = (copies[-1].tail or '') + elem.tail
+            parent.remove(elem)
+
+        if remaining:
+            inxml.xinclude()
+
+    @classmethod
+    def fragment(cls, elem):
+        # The nodes an include is replaced with and the files they came
+        # from, or None if it is not a plain include of a local document
+        href = elem.get('href')
+        if not href or '#' in href or '://' in href:
+            return None
+        if elem.get('parse', 'xml') != 'xml' or elem.get('xpointer') is not None:
+            return None
+        if len(elem) or elem.getparent() is None or elem.base is None:
+            return None
+
+        # Bases written by libxml2 depend only on the including directory
+        key = (os.path.dirname(elem.base), href)
+        entry = cls._fragments.get(key)
+        if entry is not None and not key in cls._verified:
+            if manifest.changed(entry[1]):
+                cls._fragments.remove(key)
+                entry = None
+
+        if entry is None:
+            # Errors are left for the include in the page to report
+            path = os.path.join(os.path.dirname(manifest.filename(elem.base)), urllib.unquote(href))
+            if not os.path.isfile(path):
+                return None
+
+            # Let libxml2 include it into an empty document at the same base
+            recorder = manifest.Recorder()
+            parser = etree.XMLParser()
+            parser.resolvers.add(recorder)
+
+            wrapper = etree.fromstring('<wrapper/>', parser, base_url=elem.base)
+            etree.SubElement(wrapper, cls.xincludetag, href=href)
+            try:
+                etree.ElementTree(wrapper).xinclude()
+            except etree.XIncludeError:
+                etree.clear_error_log()
+                return None
+            if len(wrapper) == 0 or wrapper.text:
+                return None
+
+            # Copied elements are not registered as IDs, so fragments
+            # declaring any are always included by libxml2
+            nodes = list(wrapper)
+            if wrapper.xpath('boolean(//@*[id(.)])'):
+                nodes = None
+
+            entry = (nodes, manifest.stamps(recorder.reset()))
+            cls._fragments.set(key, *entry)
+
+        cls._verified.add(key)
+        return entry
+
+    def buildparsed(self, page, inxml, files, state=None):
+        # Without a document, the state was read while parsing
+        record = page.record
+        if record is None:
+            with profiler.phase('stat'):
+                sources = set(files)
+                sources.add(page.sourcefile)
+                sources.update(self.files)
+                sources = manifest.stamps(sources)
+
+            # Parse the state
+            if inxml is not None:
+                with profiler.phase('state'):
+                    state = self.buildstate(inxml)
+        else:
+            sources = record['sources']
+            state = record['states']
+
+        # Build
+        deps = set(self.files)
+        written = self.build(inxml, page.targetfile, page.params, deps, page.output)
+        if written is None:
+            (status, digest, output) = ('IGN', None, None)
+            if os.path.isfile(page.targetfile):
+                os.unlink(page.targetfile)
+        else:
+            (digest, changed) = written
+            status = 'OK' if changed else 'KEEP'
+
+        with profiler.phase('stat'):
+            deps = manifest.stamps(deps)
+            if digest is not None:
+                output = manifest.stamp(page.targetfile)
+
+        return (status, {
+            'target': page.reldest,
+            'built': written is not None,
+            'params': page.phash,
+            'sources': sources,
+            'states': state,
+            'deps': deps,
+            'digest': digest,
+            'output': output
+        }, profiler.current())
+
+    def runserial(self, pages):
+        for page in pages:
+            util.message('Transforming: ' + page.relpath)
+            (status, record, timings) = self.process(page)
+            util.status(status)
+
+            yield (page.relpath, status, record, timings)
+
+    def runparallel(self, pages, jobs):
+        # Results are reported in order
+        self.warmxslt()
+        pool = multiprocessing.Pool(jobs, _initworker, (self,))
+        try:
+            window = jobs * 4
+            pending = collections.deque()
+
+            def finish():
+                (relpath, result) = pending.popleft()
+
+                util.message('Transforming: ' + relpath)
+                if not isinstance(result, tuple):
+                    result = result.get()
+                util.status(result[0])
+                return (relpath,) + result
+
+            def ready():
+                result = pending[0][1]
+                return isinstance(result, tuple) or result.ready()
+
+            for page in pages:
+                result = self.check(page)
+                if result is None:
+                    result = pool.apply_async(_process, (page,))
+                pending.append((page.relpath, result))
+
+                while pending and (len(pending) > window or ready()):
+                    yield finish()
+
+            while pending:
+                yield finish()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def dependencies(self):
+        # Every file that the last build depended on
+        result = set(self.files)
+        if self.manifest is not None:
+            for (relpath, record) in self.manifest.items():
+                result.update(record['sources'])
+                result.update(record['deps'])
+
+        return result
+
+    def uptodate(self, record, targetfile, phash):
+        # Sources are checked by the caller, ignored documents have no target
+        if not record['built']:
+            return True
+
+        if record['params'] != phash or not os.path.isfile(targetfile):
+            return False
+
+        return not self.changed(record['deps'])
+
+    def changed(self, deps):
+        if not self.trusted:
+            return manifest.changed(deps)
+
+        # Files in trusted directories are not checked, others only once
+        for path in deps:
+            if os.path.dirname(path) in self.trusted:
+                continue
+
+            if not path in self.stamped:
+                self.stamped[path] = manifest.stamp(path)
+            if self.stamped[path] != deps[path]:
+                return True
+
+        return False
 
     def buildstate(self, inxml):
         root = inxml.getroot().tag
@@ -225,97 +888,368 @@ class Builder(object):
         else:
             return []
 
-    def build(self, inxml, targetfile, params):
-        out = self.buildhtml(inxml, params)
-
-        if not out is None:
-            targetdir = os.path.dirname(targetfile)
+    def build(self, inxml, targetfile, params, deps=None, previous=None):
+        # Returns the digest of the output and whether the target changed,
+        # or None if nothing was built
+        result = self.buildxml(inxml, params, deps) if inxml is not None else None
 
-            if not os.path.isdir(targetdir):
-                os.makedirs(targetdir)
+        if not result is None:
+            # Serialize once, everything after works on pieces of this
+            with profiler.phase('serialize'):
+                output = etree.tostring(result, pretty_print=True)
+            del result
 
-            file(targetfile, 'wb').write(out.encode(self.encoding))
-            return True
+            return self.write(targetfile, profiler.iterate('cleanup', self.chunks(output, params)), previous)
         else:
-            return False
+            return None
+
+    def write(self, filename, chunks, previous=None):
+        # Write to a temporary file and rename it into place
+        util.makedirs(os.path.dirname(filename))
+
+        tempname = '{0}.{1}.tmp'.format(filename, os.getpid())
+        encoder = codecs.getincrementalencoder(self.encoding)()
+        digest = hashlib.md5()
+        try:
+            with profiler.phase('write'):
+                with open(tempname, 'wb') as handle:
+                    for chunk in chunks:
+                        data = encoder.encode(chunk)
+                        handle.write(data)
+                        digest.update(data)
+                    data = encoder.encode('', True)
+                    handle.write(data)
+                    digest.update(data)
+                digest = digest.hexdigest()
+
+                # Keep the old target if it is what was last written and
+                # has the same content
+                if previous is not None and previous[0] == digest and manifest.stamp(filename) == previous[1]:
+                    os.unlink(tempname)
+                    return (digest, False)
+
+                util.rename(tempname, filename)
+                return (digest, True)
+        except:
+            if os.path.exists(tempname):
+                os.unlink(tempname)
+            raise
 
     def cleanup(self, output, params):
+        return ''.join(self.chunks(output, params))
+
+    def chunks(self, output, params):
         # Remove leading/tailing whitespace
-        output = output.strip()
+        start = 0
+        end = len(output)
+        while start < end and output[start].isspace():
+            start += 1
+        while end > start and output[end - 1].isspace():
+            end -= 1
 
         # Remove <?xml .. ?>
-        if output[:2] == '<?':
-            pos = output.find('?>')
+        if output.startswith('<?', start, end):
+            pos = output.find('?>', start, end)
             if pos >= 0:
-                output = output[pos + 2:]
-                output = output.lstrip()
+                start = pos + 2
+                while start < end and output[start].isspace():
+                    start += 1
 
         # Remove <!DOCTYPE ... >
-        if output[:2] == '<!':
-            pos = output.find('>')
-            if pos > 0:
-                output = output[pos + 1:]
-                output = output.lstrip()
+        if output.startswith('<!', start, end):
+            pos = output.find('>', start, end)
+            if pos > start:
+                start = pos + 1
+                while start < end and output[start].isspace():
+                    start += 1
+
+        # Add header and footer to output
+        if self.headerparts:
+            for part in self.fill(self.headerparts, params):
+                yield part
+            yield '\n'
+
+        chunks = self.split(output, start, end)
+        for stage in self.stages:
+            chunks = stage(chunks)
+
+        for chunk in chunks:
+            yield chunk
+
+        if self.footerparts:
+            yield '\n'
+            for part in self.fill(self.footerparts, params):
+                yield part
+
+    # Size of the pieces the output is cleaned up and written in
+    chunksize = 65536
+
+    def split(self, output, start, end):
+        # Pieces end with '>\n' so no tag or line is ever split
+        if self.chunked:
+            while end - start > self.chunksize:
+                pos = output.find('>\n', start + self.chunksize, end)
+                if pos < 0:
+                    break
+
+                yield output[start:pos + 2]
+                start = pos + 2
+
+        if start < end:
+            yield output[start:end]
+
+    def buildstages(self):
+        # The cleanup stages, compiled once and applied in order to the
+        # pieces of the output
+        stages = []
 
         # Fix closing tags: <tag /> -> <tag></tag> by changing all tags except those allowed to be empty
         if len(self.emptytags) > 0:
-            output = re.sub(r'(?si)<(?!'+ r'|'.join(self.emptytags) + r')([a-zA-Z0-9:]*?)(((\s[^>]*?)?)/>)', r'<\1\3></\1>', output)
+            namere = re.compile(r'(?i)<(?!' + r'|'.join(self.emptytags) + r')([a-zA-Z0-9:]*)')
+
+            def fixempty(output):
+                # Only the few '/>' are looked for, each ends the tag opened
+                # after the last '>' before it, if any
+                pos = 0
+                result = []
+
+                end = output.find('/>')
+                while end >= 0:
+                    start = output.find('<', output.rfind('>', pos, end) + 1 or pos, end)
+                    while start >= 0:
+                        match = namere.match(output, start, end)
+                        if match:
+                            rest = match.end()
+                            if rest == end or output[rest].isspace():
+                                name = match.group(1)
+                                result.append(output[pos:start])
+                                result.append('<' + name + output[rest:end] + '></' + name + '>')
+                                pos = end + 2
+                                break
+
+                        start = output.find('<', start + 1, end)
+
+                    end = output.find('/>', end + 2)
+
+                if pos == 0:
+                    return output
+
+                result.append(output[pos:])
+                return ''.join(result)
+
+            stages.append(lambda chunks: (fixempty(i) for i in chunks))
 
         # Find and replace
-        for pair in self.replacements:
-            output = output.replace(pair[0], pair[1])
+        for (find, replace) in self.replacements:
+            stages.append(lambda chunks, find=find, replace=replace: (i.replace(find, replace) for i in chunks))
 
         # Strip whitespace from empty lines and start of lines
         if self.strip:
-            pos = 0
-            result = ''
+            stripre = re.compile(r'\n\s+')
+
+            def clean(text):
+                # Each piece starts a line, as far as stripping goes
+                return stripre.sub('\n', text.lstrip())
+
+            # Ignoring case would stop the searches from skipping quickly
+            # to each '<', so tag names match either case by themselves
+            def nocase(name):
+                return ''.join('[' + i.lower() + i.upper() + ']' if i.isalpha() else re.escape(i) for i in name)
 
             # Make sure to preserve certain tags
             if len(self.preservetags) > 0:
-                pattern = r'(?si)<(' + r'|'.join(self.preservetags) + r')(>|\s[^>]*?>).*?</\1>'
-                matches = re.finditer(pattern, output)
+                openre = re.compile(r'(?s)<(' + r'|'.join(nocase(i) for i in self.preservetags) + r')(>|\s[^>]*?>)')
+            else:
+                openre = None
+
+            closeres = {}
+            def closere(name):
+                name = name.lower()
+                if not name in closeres:
+                    closeres[name] = re.compile(r'</' + nocase(name) + r'>')
+                return closeres[name]
+
+            def strip(output, final):
+                # Returns the stripped text and the opening of any preserved
+                # tag at the end that the next piece may still close
+                pos = 0
+                search = 0
+                result = []
+
+                while openre:
+                    match = openre.search(output, search)
+                    if match is None:
+                        break
 
-                for match in matches:
                     offset = match.start()
+                    close = closere(match.group(1)).search(output, match.end())
+                    if close is None and not final:
+                        if offset > pos:
+                            result.append(clean(output[pos:offset]))
+                        return (''.join(result), match)
+                    elif close is None:
+                        search = offset + 1
+                        continue
+
                     if offset > pos:
-                        result += re.sub(r'(?m)^\s+', r'', output[pos:offset])
-                
-                    result += match.group()
-                    pos = match.end()
+                        result.append(clean(output[pos:offset]))
 
-            # Any leftover is also stripped
-            if pos < len(output):
-                result += re.sub(r'(?m)^\s+', r'', output[pos:])
+                    result.append(output[offset:close.end()])
+                    pos = search = close.end()
 
-            output = result
-    
-        # Add header and footer to output
-        def helper(mo):
-            key = mo.group(1)
-            if key == '':
-                return '@';
-            return params[key]
+                # Any leftover is also stripped
+                if pos < len(output):
+                    result.append(clean(output[pos:]))
+
+                return (''.join(result), None)
+
+            def stripper(chunks):
+                # The pieces of an open preserved tag are held until one
+                # closes it, only new pieces are searched for the close
+                held = []
+                for chunk in chunks:
+                    if held:
+                        close = search.search(tail + chunk)
+                        if close is None:
+                            held.append(chunk)
+                            tail = (tail + chunk)[-size:]
+                            continue
+
+                        end = close.end() - len(tail)
+                        held.append(chunk[:end])
+                        yield ''.join(held)
+
+                        held = []
+                        chunk = chunk[end:]
+
+                    (result, match) = strip(chunk, False)
+                    yield result
 
-        if len(self.header) > 0:
-            output = re.sub('@([a-zA-Z0-9]*?)@', helper, self.header) + "\n" + output
+                    if match:
+                        held = [chunk[match.start():]]
+                        search = closere(match.group(1))
+                        size = len(match.group(1)) + 2
+                        tail = chunk[match.end():][-size:]
 
-        if len(self.footer) > 0:
-            output = output + "\n" + re.sub('@([a-zA-Z0-9]*?)@', helper, self.footer)
+                if held:
+                    yield strip(''.join(held), True)[0]
 
-        return output
+            stages.append(stripper)
+
+        return stages
+
+    @staticmethod
+    def template(text):
+        # Split into literal text and @name@ parameters, alternating
+        if len(text) > 0:
+            return re.split('@([a-zA-Z0-9]*?)@', text)
+        return []
+
+    @staticmethod
+    def fill(parts, params):
+        for (i, part) in enumerate(parts):
+            if i % 2 == 0:
+                yield part
+            elif part == '':
+                yield '@'
+            else:
+                yield params[part]
 
 
     _cache = {}
+    _fragments = manifest.Fragments()
+    _recorders = {}
+    _closures = {}
+    _verified = set()
     @classmethod
-    def getxslt(cls, path):
+    def getxslt(cls, path, cachedir=None):
+        # Check the files a stylesheet was built from once per build
+        if path in cls._cache and not path in cls._verified:
+            if manifest.changed(cls._closures[path]):
+                cls.invalidate(set([path]))
+
         if not path in cls._cache:
-            xslxml = etree.parse(path)
-            xslxml.xinclude()
+            # Record the stylesheet's includes, imports and document() loads
+            recorder = manifest.Recorder()
+            parser = etree.XMLParser()
+            parser.resolvers.add(recorder)
+
+            (xslxml, closure) = cls.loadxslt(path, cachedir, parser)
+            if xslxml is None:
+                xslxml = etree.parse(path, parser)
+                xslxml.xinclude()
+
+                closure = recorder.reset()
+                closure.add(path)
+                if cachedir is not None and len(closure) > 1:
+                    cls.savexslt(path, cachedir, xslxml, closure)
+
             cls._cache[path] = etree.XSLT(xslxml)
 
+            closure.update(recorder.reset())
+            cls._closures[path] = manifest.stamps(closure)
+            cls._recorders[path] = recorder
+
+        cls._verified.add(path)
         return cls._cache[path]
 
-    def buildxml(self, xml, params):
+    @staticmethod
+    def xsltfile(path, cachedir):
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        return os.path.join(cachedir, 'xslt', hashlib.md5(path).hexdigest())
+
+    @classmethod
+    def loadxslt(cls, path, cachedir, parser):
+        # A stylesheet tree saved with its xincludes done, if still current
+        if cachedir is None:
+            return (None, None)
+
+        try:
+            with open(cls.xsltfile(path, cachedir), 'rb') as handle:
+                data = cPickle.load(handle)
+        except (IOError, EOFError, ValueError, cPickle.UnpicklingError):
+            return (None, None)
+
+        if data.get('path') != path or manifest.changed(data['sources']):
+            return (None, None)
+
+        xslxml = etree.ElementTree(etree.fromstring(data['tree'], parser, base_url=path))
+        return (xslxml, set(data['sources']))
+
+    @classmethod
+    def savexslt(cls, path, cachedir, xslxml, closure):
+        filename = cls.xsltfile(path, cachedir)
+        util.makedirs(os.path.dirname(filename))
+
+        data = { 'path': path, 'sources': manifest.stamps(closure), 'tree': etree.tostring(xslxml) }
+
+        # Workers may save the same stylesheet at once
+        tempname = '{0}.{1}.tmp'.format(filename, os.getpid())
+        with open(tempname, 'wb') as handle:
+            cPickle.dump(data, handle, cPickle.HIGHEST_PROTOCOL)
+        util.rename(tempname, filename)
+
+    @classmethod
+    def invalidate(cls, paths):
+        # Forget compiled stylesheets built from any of the paths
+        for path in list(cls._cache):
+            if any(i in cls._closures[path] for i in paths):
+                del cls._cache[path]
+                del cls._closures[path]
+                del cls._recorders[path]
+
+    def warmxslt(self):
+        # Compile every stylesheet so forked workers start with them
+        cachedir = self.config.opts.cachedir
+        for xsl in sorted(set(self.transforms.values()) - set([None])):
+            try:
+                self.getxslt(self.config.path(xsl), cachedir)
+            except (etree.Error, IOError):
+                # Reported by the pages that use it, if any
+                pass
+
+    def buildxml(self, xml, params, deps=None):
         # Prepare parameters
         params = dict(params)
         for i in params:
@@ -324,14 +1258,29 @@ class Builder(object):
         # Build
         result = None
         root = xml.getroot()
-        if root.tag in self.transforms:
-            transform = self.getxslt(self.config.path(self.transforms[root.tag]))
-            result = transform(xml, **params)
+        if self.transforms.get(root.tag):
+            path = self.config.path(self.transforms[root.tag])
+            with profiler.phase('compile'):
+                transform = self.getxslt(path, self.config.opts.cachedir)
+
+            timings = profiler.current()
+            if timings is not None:
+                timings.stylesheet = path
+
+            self._recorders[path].reset()
+            setup.readfiles()
+            with profiler.phase('xslt'):
+                result = transform(xml, **params)
+
+            if deps is not None:
+                deps.update(self._closures[path])
+                deps.update(self._recorders[path].reset())
+                deps.update(setup.readfiles())
 
         return result
 
-    def buildhtml(self, xml, params):
-        result = self.buildxml(xml, params)
+    def buildhtml(self, xml, params, deps=None):
+        result = self.buildxml(xml, params, deps)
         if not result is None:
             result = self.cleanup(etree.tostring(result, pretty_print=True), params)
 
@@ -343,8 +1292,104 @@ class Builder(object):
 
         util.message('Building state:')
 
+        statedir = self.config.opts.statedir
+
+        # What was written last time, by file name
+        index = self.manifest.extra.get('state')
+        if index is None or index['statedir'] != statedir:
+            index = { 'statedir': statedir, 'files': {} }
+
+        # Only files whose contents changed are built and saved
+        compressor = self.getcompressor() if self.compresslevel is not None else None
+        digests = {}
+        for (filename, digest, build) in self.statefiles(states):
+            realfile = os.path.join(statedir, filename)
+            previous = index['files'].get(filename)
+
+            if previous != digest or not os.path.isfile(realfile):
+                self.savefile(build(), realfile, previous is None, compressor)
+            elif compressor is not None and not os.path.isfile(compress.sidecar(realfile)):
+                compressor.add(realfile)
+            digests[filename] = digest
+
+        # Remove files that are no longer produced
+        for filename in index['files']:
+            if not filename in digests:
+                realfile = os.path.join(statedir, filename)
+                if os.path.isfile(realfile):
+                    os.unlink(realfile)
+                if compressor is not None:
+                    compressor.remove(realfile)
+
+        self.manifest.extra['state'] = { 'statedir': statedir, 'files': digests }
+
+        util.status('OK')
+
+    def dumpstate(self, states):
+        # Saves the states of this shard for merge-state
+        (index, count) = self.shard
+        filename = os.path.join(self.config.opts.cachedir, '{0}.state-{1}-of-{2}.json'.format(self.name, index, count))
+
+        entries = collections.OrderedDict()
+        for (relpath, state) in states:
+            if not relpath in entries:
+                entries[relpath] = [self.order[relpath], relpath.replace(os.sep, '/'), []]
+            entries[relpath][2].append(state.dump())
+
+        data = { 'version': 1, 'builder': self.name, 'shard': [index, count], 'states': entries.values() }
+
+        util.makedirs(os.path.dirname(filename))
+        tempname = '{0}.{1}.tmp'.format(filename, os.getpid())
+        with open(tempname, 'wb') as handle:
+            json.dump(data, handle)
+        util.rename(tempname, filename)
+
+        util.log('State dump: {0}'.format(filename))
+
+    def mergestate(self, filenames):
+        # Builds the state files from the dumps of every shard of a build
+        (entries, shards) = ([], set())
+        for filename in filenames:
+            with open(filename, 'rb') as handle:
+                data = json.load(handle)
+
+            if data.get('version') != 1 or data.get('builder') != self.name:
+                raise ValueError('Not a state dump of builder {0}: {1}'.format(self.name, filename))
+
+            shard = tuple(data['shard'])
+            if shard in shards:
+                raise ValueError('State dump given twice: {0}'.format(filename))
+            shards.add(shard)
+            entries.extend(data['states'])
+
+        count = list(shards)[0][1]
+        if shards != set((i, count) for i in range(1, count + 1)):
+            raise ValueError('State dumps of every shard are needed')
+
+        # In the order a single build would have seen the sources
+        states = []
+        for (index, relpath, dumps) in sorted(entries, key=lambda entry: entry[0]):
+            relpath = relpath.replace('/', os.sep)
+            states.extend([(relpath, _State.load(i)) for i in dumps])
+
+        # What was written last time is remembered like a normal build
+        cachedir = self.config.opts.cachedir
+        if cachedir is None:
+            self.manifest = manifest.Manifest(None)
+        else:
+            self.manifest = manifest.Manifest(os.path.join(cachedir, self.name + '.merge'))
+
+        self.savestate(states)
+        self.waitsidecars()
+        if cachedir is not None:
+            self.manifest.save()
+
+    def statefiles(self, states):
+        # Yields the name of each state file, a digest of what goes in it,
+        # and a function to build it
+
         # Sort our state data
-        states = sorted(states, key=lambda entry: entry[1], reverse=True)
+        states = sorted(states, key=lambda entry: entry[1].key, reverse=True)
 
         # Build our tags lists
         tags = {}
@@ -356,15 +1401,35 @@ class Builder(object):
 
                     tags[tag].append(entry)
 
+        # Each entry is only digested once however many files it is in
+        digests = {}
+        def digest(entry):
+            key = id(entry[1])
+            if not key in digests:
+                state = entry[1]
+                data = (entry[0], state.bookmark, state.year, state.month, state.day, state.title, state.tags, state.summary)
+                digests[key] = hashlib.md5(repr(data)).digest()
+
+            return digests[key]
+
         # Build each specific state item
-        self.savestatefile(self.config.opts.statedir, self.config.opts.staterecentname, states)
+        files = [(self.config.opts.staterecentname, states, None)]
         for tag in tags:
-            self.savestatefile(self.config.opts.statedir, tag, tags[tag], tag)
-        self.savetagsfile(self.config.opts.statedir, tags)
+            files.append((tag, tags[tag], tag))
 
-        util.status('OK')
+        for (name, entries, tagname) in files:
+            for page in self.statepages(name, entries, tagname):
+                data = hashlib.md5(repr(page[1:4]))
+                for entry in page[4]:
+                    data.update(digest(entry))
+
+                yield (page[0], data.hexdigest(), lambda page=page: self.statetree(*page[1:]))
+
+        filename = '{0}.xml'.format(self.config.opts.statetagsname)
+        counts = [(tag, len(tags[tag])) for tag in sorted(tags.keys())]
+        yield (filename, hashlib.md5(repr(counts)).hexdigest(), lambda: self.tagstree(counts))
 
-    def savestatefile(self, statedir, name, entries, tagname=None):
+    def statepages(self, name, entries, tagname=None):
         count = int(self.config.opts.statepagination)
         if count < 2:
             count = 2
@@ -391,97 +1456,99 @@ class Builder(object):
                 nextname = None
 
             # Determine information
-            realfile = os.path.join(statedir, filename)
             section = entries[pos:pos + count]
 
             # Don't forget to increase counter
             pos += count
             page += 1
 
-            # Root node
-            ns = self.statens
-            state = etree.Element(ns + 'state')
-            if prevname:
-                state.set('prev', prevname)
-            if nextname:
-                state.set('next', nextname)
-            if tagname:
-                state.set('tag', tagname)
-
-            # Child nodes
-            for i in section:
-                sub = etree.SubElement(state, ns + 'entry')
-
-                # Relpath and bookmark
-                sub.set('relpath', i[0].replace(os.sep, '/'))
-                if i[1].bookmark:
-                    sub.set('bookmark', i[1].bookmark)
-
-
-                # Modified
-                mod = etree.SubElement(sub, ns + 'modified')
-                mod.set('year', i[1].year)
-                mod.set('month', i[1].month)
-                mod.set('day', i[1].day)
-
-                # Title
-                title = etree.SubElement(sub, ns + 'title')
-                title.text = i[1].title
-
-                # Tags
-                for t in i[1].tags:
-                    tag = etree.SubElement(sub, ns + 'tag')
-                    tag.set('name', t)
-
-                # Summarries
-                summary = etree.SubElement(sub, ns + 'summary')
-                summary.text = i[1].summary
-
-            # Save
-            tree = etree.ElementTree(state)
-            self.savefile(tree, realfile)
-
-    def savetagsfile(self, statedir, tags):
-        filename = '{0}.xml'.format(self.config.opts.statetagsname)
-
-        # Determine information
-        realfile = os.path.join(statedir, filename)
+            yield (filename, prevname, nextname, tagname, section)
 
+    def statetree(self, prevname, nextname, tagname, section):
+        # Root node
+        ns = self.statens
+        state = etree.Element(ns + 'state')
+        if prevname:
+            state.set('prev', prevname)
+        if nextname:
+            state.set('next', nextname)
+        if tagname:
+            state.set('tag', tagname)
+
+        # Child nodes
+        for i in section:
+            sub = etree.SubElement(state, ns + 'entry')
+
+            # Relpath and bookmark
+            sub.set('relpath', i[0].replace(os.sep, '/'))
+            if i[1].bookmark:
+                sub.set('bookmark', i[1].bookmark)
+
+
+            # Modified
+            mod = etree.SubElement(sub, ns + 'modified')
+            mod.set('year', i[1].year)
+            mod.set('month', i[1].month)
+            mod.set('day', i[1].day)
+
+            # Title
+            title = etree.SubElement(sub, ns + 'title')
+            title.text = i[1].title
+
+            # Tags
+            for t in i[1].tags:
+                tag = etree.SubElement(sub, ns + 'tag')
+                tag.set('name', t)
+
+            # Summarries
+            summary = etree.SubElement(sub, ns + 'summary')
+            summary.text = i[1].summary
+
+        return etree.ElementTree(state)
+
+    def tagstree(self, counts):
         # Prepare to build the document
         ns = self.statens
         root = etree.Element(ns + 'tags')
 
-        keys = sorted(tags.keys())
-        for tag in keys:
+        for (tag, count) in counts:
             sub = etree.SubElement(root, ns + 'tag')
             sub.set('name', tag)
             sub.set('file', '{0}.xml'.format(tag))
-            sub.set('count', str(len(tags[tag])))
+            sub.set('count', str(count))
 
-        # Save
-        tree = etree.ElementTree(root)
-        self.savefile(tree, realfile)
+        return etree.ElementTree(root)
 
     @staticmethod
-    def savefile(tree, filename):
+    def savefile(tree, filename, compare=True, compressor=None):
         # Create directory if not exist
-        dirname = os.path.dirname(filename)
-        if not os.path.isdir(dirname):
-            os.makedirs(dirname)
+        util.makedirs(os.path.dirname(filename))
+
+        contents = Builder.serialize(tree)
+
+        # Save the output only if it differs from an existing file, unless
+        # the caller already knows that it does
+        if compare and os.path.isfile(filename):
+            with open(filename, 'rU') as handle:
+                current = handle.read()
+            if current == contents:
+                if compressor is not None and not os.path.isfile(compress.sidecar(filename)):
+                    compressor.add(filename, contents)
+                return
+
+        tempname = '{0}.{1}.tmp'.format(filename, os.getpid())
+        with open(tempname, 'wb') as handle:
+            handle.write(contents)
+        util.rename(tempname, filename)
 
-        # Save the output only if it differs from an existing file
+        if compressor is not None:
+            compressor.add(filename, contents)
+
+    @staticmethod
+    def serialize(tree):
         output = cStringIO.StringIO()
         tree.write(output, encoding="utf-8", xml_declaration=True, pretty_print=True)
         contents = output.getvalue().replace('\r\n', '\n').replace('\r', '\n')
         output.close()
 
-        if os.path.isfile(filename):
-            with open(filename, 'rU') as handle:
-                current = handle.read()
-            if current != contents:
-                with open(filename, 'wb') as handle:
-                    handle.write(contents)
-        else:
-            with open(filename, 'wb') as handle:
-                handle.write(contents)
-
+        return contents
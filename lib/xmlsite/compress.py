@@ -0,0 +1,97 @@
+# File:         compress.py
+# Author:       Brian Allen Vanderburg II
+# Purpose:      Write compressed copies of output files in the background
+# License:      Refer to the file license.txt
+
+import os
+import gzip
+import cStringIO
+import threading
+import multiprocessing
+import Queue
+
+from . import util
+
+
+def level(value):
+    # The compression level given to a builder, or None if not compressing
+    if value is None or value.lower() in ('no', 'false', 'off', '0'):
+        return None
+    if util.getbool(value):
+        return 9
+
+    try:
+        result = int(value)
+    except ValueError:
+        result = None
+    if result is None or result < 1 or result > 9:
+        raise ValueError('Invalid compression level: {0}'.format(value))
+
+    return result
+
+def sidecar(filename):
+    return filename + '.gz'
+
+
+# Files are compressed by a pool of threads, zlib does not hold the
+# interpreter lock while it works
+class Compressor(object):
+    def __init__(self, level, threads=None):
+        self.level = level
+        self.queue = Queue.Queue()
+        self.errors = []
+
+        self.threads = []
+        for i in range(threads or multiprocessing.cpu_count()):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def add(self, filename, data=None):
+        # The file is read when compressed unless its content is given
+        self.queue.put((filename, data))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            (filename, data) = item
+            try:
+                self.compress(filename, data)
+            except (IOError, OSError) as e:
+                self.errors.append(e)
+
+    def compress(self, filename, data):
+        if data is None:
+            with open(filename, 'rb') as handle:
+                data = handle.read()
+
+        # The same content always gives the same bytes
+        output = cStringIO.StringIO()
+        with gzip.GzipFile(os.path.basename(filename), 'wb', self.level, output, 0) as handle:
+            handle.write(data)
+
+        target = sidecar(filename)
+        tempname = '{0}.{1}.{2}.tmp'.format(target, os.getpid(), threading.current_thread().ident)
+        with open(tempname, 'wb') as handle:
+            handle.write(output.getvalue())
+        util.rename(tempname, target)
+
+    def remove(self, filename):
+        target = sidecar(filename)
+        if os.path.isfile(target):
+            os.unlink(target)
+
+    def close(self):
+        # Stops the threads once everything queued is done, and raises
+        # the first error
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+        if self.errors:
+            raise self.errors[0]
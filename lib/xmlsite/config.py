@@ -8,6 +8,7 @@ import os
 from lxml import etree
 
 from .builder import Builder
+from .group import Group
 
 class Config(object):
     def __init__(self, opts):
@@ -15,13 +16,21 @@ class Config(object):
         self.opts = opts
 
         filename = os.path.normpath(self.opts.config)
+        self.filename = self.cwdpath(filename)
         self.confdir = os.path.normpath(os.path.dirname(filename))
 
-        # Update some paths
-        self.opts.indir = self.cwdpath(self.opts.indir)
-        self.opts.outdir = self.cwdpath(self.opts.outdir)
+        # Update some paths, merging state needs no input or output
+        if not self.opts.indir is None:
+            self.opts.indir = self.cwdpath(self.opts.indir)
+        if not self.opts.outdir is None:
+            self.opts.outdir = self.cwdpath(self.opts.outdir)
         if not self.opts.statedir is None:
             self.opts.statedir = self.cwdpath(self.opts.statedir)
+        if not self.opts.cachedir is None:
+            self.opts.cachedir = self.cwdpath(self.opts.cachedir)
+        elif not self.opts.outdir is None:
+            # Next to the output rather than in it, so it isn't published
+            self.opts.cachedir = self.opts.outdir + '.xmlsite'
 
         # Parse document
         xml = etree.parse(filename)
@@ -44,11 +53,33 @@ class Config(object):
             if name and value:
                 self.properties[name] = value;
 
-    def execute(self):
-        if self.opts.builder in self.builders:
-            self.builders[self.opts.builder].execute()
+    def execute(self, changed=None):
+        builders = self.selected()
+        if len(builders) == 1:
+            builders[0].execute(changed)
         else:
-            raise ValueError('No such builder: ' + self.opts.builder)
+            Group(self, builders).execute(changed)
+
+    def builder(self):
+        return self.selected()[0]
+
+    def statebuilder(self):
+        # The selected builder whose state is saved
+        builders = self.selected()
+        if len(builders) == 1:
+            return builders[0]
+        return Group(self, builders).stated
+
+    def selected(self):
+        # The builders named on the command line, in order
+        result = []
+        for name in self.opts.builders:
+            if name in self.builders:
+                result.append(self.builders[name])
+            else:
+                raise ValueError('No such builder: ' + name)
+
+        return result
 
     def path(self, relpath):
         # return abs path relative to config, relpath may contain '...', so normalize/make absolute
@@ -0,0 +1,217 @@
+# File:         group.py
+# Author:       Brian Allen Vanderburg II
+# Purpose:      Run several builders over the input in a single pass
+# License:      Refer to the file license.txt
+
+import os
+import collections
+import multiprocessing
+
+from lxml import etree
+
+from . import util
+from . import profiler
+from . import setup
+
+
+# Worker process support for parallel builds
+_worker = None
+
+def _initworker(group):
+    global _worker
+    _worker = group
+    setup.setup(group.config)
+
+def _process(job):
+    try:
+        return _worker.build(*job)
+    except etree.Error as e:
+        # lxml errors do not survive the trip back to the parent
+        raise util.Error(util.errortext(e).rstrip('\n'))
+
+
+class Group(object):
+    def __init__(self, config, builders):
+        self.config = config
+        self.builders = builders
+
+        # They share a state directory, so only one may save a state there,
+        # without one the first builder with a state saves it
+        stated = [builder for builder in builders if builder.states]
+        if len(stated) > 1 and not config.opts.statedir is None:
+            raise ValueError('Only one of the builders run together may have a state: {0}'.format(', '.join(builder.name for builder in stated)))
+        self.stated = stated[0] if stated else builders[0]
+
+    def execute(self, changed=None):
+        for builder in self.builders:
+            builder.begin(changed is None)
+
+        # Each source is listed with the pages the builders make from it
+        if changed is None:
+            sources = self.scan()
+        else:
+            sources = self.affected(changed)
+
+        jobs = self.config.opts.jobs
+        if jobs > 1:
+            results = self.runparallel(sources, jobs)
+        else:
+            results = self.runserial(sources)
+
+        if self.config.opts.profile:
+            report = profiler.Report(self.config.opts.profiletop)
+        else:
+            report = None
+
+        # Builders finish with the results of their own pages
+        collected = [[] for builder in self.builders]
+        for (index, result) in results:
+            if self.builders[index].compresslevel is not None:
+                self.builders[index].sidecar(result)
+            collected[index].append(result)
+
+        # Only the builder with a state saves or dumps it
+        for (index, builder) in enumerate(self.builders):
+            builder.finish(changed, collected[index], report, builder is self.stated)
+
+        if report is not None:
+            report.save(self.config.opts.profile)
+
+    def scan(self):
+        sourceroot = self.config.opts.indir
+
+        # The first builder keeps the snapshot of the shared walk
+        (snapshot, current) = self.builders[0].beginsnapshot()
+        for builder in self.builders:
+            if builder is not self.builders[0]:
+                builder.manifest.extra.pop('snapshot', None)
+            builder.order = {}
+
+        # Only directories that every builder excludes are skipped
+        excluded = None
+        if all(builder.excludeddirs for builder in self.builders):
+            excluded = lambda compare: all(builder.excludeddirs(compare) for builder in self.builders)
+
+        for (reldir, files, trusted) in self.builders[0].walk(sourceroot, snapshot, current, excluded):
+            if trusted:
+                dir = os.path.normpath(os.path.join(sourceroot, reldir))
+                for builder in self.builders:
+                    builder.trusted.add(dir)
+
+            for f in files:
+                relpath = os.path.join(reldir, f)
+                pages = []
+                for (index, builder) in enumerate(self.builders):
+                    if not builder.walked(relpath):
+                        continue
+
+                    page = builder.select(relpath, trusted)
+                    if page is not None:
+                        pages.append((index, page))
+
+                if pages:
+                    yield (relpath, pages)
+
+    def affected(self, changed):
+        sources = collections.OrderedDict()
+        for (index, builder) in enumerate(self.builders):
+            for page in builder.affected(changed):
+                sources.setdefault(page.relpath, []).append((index, page))
+
+        for relpath in sorted(sources):
+            yield (relpath, sources[relpath])
+
+    def check(self, pages):
+        # Results known without parsing, and the pages that must be built
+        (results, remaining) = ({}, [])
+        for (index, page) in pages:
+            result = self.builders[index].check(page)
+            if result is None:
+                remaining.append((index, page))
+            else:
+                results[index] = result
+
+        return (results, remaining)
+
+    def build(self, sourcefile, pages):
+        # Parse once, then let each builder transform the same document,
+        # the parse is timed along with the first page built from it
+        profiling = self.config.opts.profile
+        if profiling:
+            profiler.begin()
+
+        results = []
+        try:
+            (inxml, files) = self.builders[pages[0][0]].parse(sourcefile)
+            for (index, page) in pages:
+                if profiling and results:
+                    profiler.begin()
+                results.append((index, self.builders[index].buildparsed(page, inxml, files)))
+                profiler.end()
+        finally:
+            profiler.end()
+
+        return results
+
+    def message(self, relpath, index):
+        util.message('Transforming: {0} ({1})'.format(relpath, self.builders[index].name))
+
+    def runserial(self, sources):
+        for (relpath, pages) in sources:
+            self.message(relpath, pages[0][0])
+            (results, remaining) = self.check(pages)
+            if remaining:
+                results.update(self.build(remaining[0][1].sourcefile, remaining))
+
+            for item in self.announce(relpath, pages, results):
+                yield item
+
+    def announce(self, relpath, pages, results):
+        # The message for the first page is already out
+        for (count, (index, page)) in enumerate(pages):
+            if count:
+                self.message(relpath, index)
+            (status, record, timings) = results[index]
+            util.status(status)
+
+            yield (index, (relpath, status, record, timings))
+
+    def runparallel(self, sources, jobs):
+        # Results are reported in order
+        for builder in self.builders:
+            builder.warmxslt()
+
+        pool = multiprocessing.Pool(jobs, _initworker, (self,))
+        try:
+            window = jobs * 4
+            pending = collections.deque()
+
+            def finish():
+                (relpath, pages, results, result) = pending.popleft()
+
+                self.message(relpath, pages[0][0])
+                if result is not None:
+                    results.update(result.get())
+                return self.announce(relpath, pages, results)
+
+            def ready():
+                result = pending[0][3]
+                return result is None or result.ready()
+
+            for (relpath, pages) in sources:
+                (results, remaining) = self.check(pages)
+                result = None
+                if remaining:
+                    result = pool.apply_async(_process, ((remaining[0][1].sourcefile, remaining),))
+                pending.append((relpath, pages, results, result))
+
+                while pending and (len(pending) > window or ready()):
+                    for item in finish():
+                        yield item
+
+            while pending:
+                for item in finish():
+                    yield item
+        finally:
+            pool.terminate()
+            pool.join()
@@ -10,35 +10,61 @@ import argparse
 from lxml import etree
 
 from . import util
+from . import reporter
 from . import setup
+from . import watch
+from . import serve
 from .config import Config
 
 class _CmdOptions(object):
     def __init__(self):
         pass
 
-def parse_cmdline():
+def parse_cmdline(args=None, command=None):
     """ Parse command line arguments """
 
+    serving = command == 'serve'
+    merging = command == 'merge-state'
+
     # Setup and parse command line
-    parser = argparse.ArgumentParser(description='Build a site from from xml files.')
+    if serving:
+        parser = argparse.ArgumentParser(prog='xmlsite serve', description='Serve a site from xml files, building pages as they are requested.')
+        parser.add_argument('--bind', dest='bind', action='store', required=False, help='address to listen on (default: 127.0.0.1)')
+        parser.add_argument('--port', dest='port', action='store', required=False, help='port to listen on (default: 8000)')
+        parser.add_argument('--threads', dest='threads', action='store', required=False, help='number of requests to handle at once (default: 4)')
+    elif merging:
+        parser = argparse.ArgumentParser(prog='xmlsite merge-state', description='Build the state files from the state dumps of a sharded build.')
+    else:
+        parser = argparse.ArgumentParser(description='Build a site from from xml files.')
+        parser.add_argument('--shard', dest='shard', action='store', required=False, help='build only part I of N of the files, given as I/N, and dump the state for merge-state')
     parser.add_argument('--config', dest='config', action='store', required=True, help='xmlsite configuration file')
-    parser.add_argument('--builder', dest='builder', action='store', required=True, help='builder to use for building')
-    parser.add_argument('--input-dir', dest='indir', action='store', required=True, help='input directory')
-    parser.add_argument('--output-dir', dest='outdir', action='store', required=True, help='output directory')
-    parser.add_argument('--state-dir', dest='statedir', action='store', required=False, help='state directory to save to')
+    parser.add_argument('--builder', dest='builder', action='store', required=True, help='builder to use for building, several separated by commas share a single pass')
+    parser.add_argument('--input-dir', dest='indir', action='store', required=not merging, help='input directory')
+    parser.add_argument('--output-dir', dest='outdir', action='store', required=not merging, help='output directory')
+    parser.add_argument('--state-dir', dest='statedir', action='store', required=merging, help='state directory to save to')
     parser.add_argument('--state-pagination', dest='statepagination', action='store', required=False, help='number of entries per state file')
     parser.add_argument('--state-recentname', dest='staterecentname', action='store', required=False, help='base name given to the the state files')
     parser.add_argument('--state-tagsname', dest='statetagsname', action='store', required=False, help='base name given to the tags file')
-    parser.add_argument('params', action='store', nargs='*', help='a list of name=value parameters for XSL processing')
+    parser.add_argument('--cache-dir', dest='cachedir', action='store', required=False, help='directory to keep build information in (default: OUTDIR.xmlsite)')
+    parser.add_argument('--jobs', dest='jobs', action='store', required=False, help='number of pages to build in parallel')
+    parser.add_argument('--watch', dest='watch', action='store_true', default=False, help='keep running and rebuild as files change')
+    parser.add_argument('--trust-dirs', dest='trustdirs', action='store_true', default=False, help='skip input directories whose modification time is unchanged since the last build')
+    parser.add_argument('--reporter', dest='reporter', action='store', required=False, choices=reporter.reporters.keys(), help='how to report progress (default: classic)')
+    parser.add_argument('--profile', dest='profile', action='store', required=False, help='time each page and write a JSON report to this file')
+    parser.add_argument('--profile-top', dest='profiletop', action='store', required=False, help='number of slowest pages and stylesheets to report')
+    if merging:
+        parser.add_argument('dumps', action='store', nargs='+', help='the state dumps of every shard')
+    else:
+        parser.add_argument('params', action='store', nargs='*', help='a list of name=value parameters for XSL processing')
 
-    result = parser.parse_args()
+    result = parser.parse_args(args)
 
     # Set global variables in this module
     opts = _CmdOptions()
 
     opts.config = result.config
-    opts.builder = result.builder
+    opts.builders = [i.strip() for i in result.builder.split(',') if i.strip()] or [result.builder]
+    opts.builder = opts.builders[0]
     opts.indir = result.indir
     opts.outdir = result.outdir
 
@@ -47,8 +73,36 @@ def parse_cmdline():
     opts.staterecentname = result.staterecentname if not result.staterecentname is None else 'recent'
     opts.statetagsname = result.statetagsname if not result.statetagsname is None else 'tags'
 
+    opts.cachedir = result.cachedir
+    opts.jobs = int(result.jobs) if not result.jobs is None else 1
+    opts.watch = result.watch
+    opts.trustdirs = result.trustdirs
+    opts.reporter = result.reporter if not result.reporter is None else 'classic'
+    opts.profile = result.profile
+    opts.profiletop = int(result.profiletop) if not result.profiletop is None else 20
+
+    opts.shard = None
+    if not merging and not serving and not result.shard is None:
+        try:
+            (index, count) = [int(i) for i in result.shard.split('/')]
+        except ValueError:
+            parser.error('--shard must be given as I/N')
+        if count < 1 or index < 1 or index > count:
+            parser.error('--shard must be given as I/N with 1 <= I <= N')
+        if result.watch:
+            parser.error('--shard can not be used with --watch')
+        opts.shard = (index, count)
+
+    opts.dumps = result.dumps if merging else []
+
+    opts.serving = serving
+    if serving:
+        opts.bind = result.bind if not result.bind is None else '127.0.0.1'
+        opts.port = int(result.port) if not result.port is None else 8000
+        opts.threads = int(result.threads) if not result.threads is None else 4
+
     opts.params = {}
-    for i in result.params:
+    for i in ([] if merging else result.params):
         pair = i.split('=', 1)
         if len(pair) == 2:
             opts.params[pair[0]] = pair[1]
@@ -56,10 +110,27 @@ def parse_cmdline():
     return opts
 
 def run():
+    args = sys.argv[1:]
+    command = None
+    if args[:1] in (['serve'], ['merge-state']):
+        command = args.pop(0)
+
     try:
-        c = Config(parse_cmdline())
+        opts = parse_cmdline(args, command)
+        util.setreporter(opts.reporter)
+
+        c = Config(opts)
+        if command == 'merge-state':
+            c.statebuilder().mergestate(opts.dumps)
+            return
+
         setup.setup(c)
-        c.execute()
+        if command == 'serve':
+            serve.run(c)
+        else:
+            c.execute()
+            if c.opts.watch:
+                watch.run(c)
     except etree.Error as e:
         util.error(e)
     except OSError as e:
@@ -68,6 +139,8 @@ def run():
         util.error(e)
     except ValueError as e:
         util.error(e)
+    except util.Error as e:
+        util.error(e)
 
 if __name__ == "__main__":
     run()
@@ -0,0 +1,147 @@
+# File:         manifest.py
+# Author:       Brian Allen Vanderburg II
+# Purpose:      Track the dependencies of each target between builds
+# License:      Refer to the file license.txt
+
+import os
+import hashlib
+import urllib
+import cPickle
+import collections
+
+from lxml import etree
+
+from . import util
+
+
+# Resolver that records the files loaded through a parser
+class Recorder(etree.Resolver):
+    def __init__(self):
+        etree.Resolver.__init__(self)
+        self.files = set()
+
+    def resolve(self, url, id, context):
+        if url:
+            self.files.add(filename(url))
+        return None
+
+    def reset(self):
+        files = self.files
+        self.files = set()
+        return files
+
+
+def filename(url):
+    if url.startswith('file://'):
+        url = urllib.unquote(url[7:])
+
+    return os.path.normpath(url)
+
+def stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    return (st.st_mtime, st.st_size)
+
+def stamps(paths):
+    return dict((path, stamp(path)) for path in paths)
+
+def changed(deps):
+    for path in deps:
+        if stamp(path) != deps[path]:
+            return True
+
+    return False
+
+def paramhash(params):
+    return hashlib.md5(repr(sorted(params.items()))).hexdigest()
+
+
+# Included documents, already parsed and processed, with the stamps of
+# the files they were read from, most recently used last
+class Fragments(object):
+    def __init__(self, limit=32 * 1024 * 1024):
+        self.limit = limit
+        self.size = 0
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.entries[key] = entry
+        return entry
+
+    def set(self, key, nodes, stamps):
+        # The size of the files stands in for the size of the nodes
+        size = sum(i[1] for i in stamps.values() if i is not None)
+        self.remove(key)
+        if size > self.limit:
+            return
+
+        self.entries[key] = (nodes, stamps, size)
+        self.size += size
+        while self.size > self.limit:
+            (key, entry) = self.entries.popitem(last=False)
+            self.size -= entry[2]
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+
+class Manifest(object):
+    version = 5
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = collections.OrderedDict()
+        self.previous = collections.OrderedDict()
+
+        # Other information about the build kept by name
+        self.extra = {}
+
+        if filename is not None and os.path.isfile(filename):
+            try:
+                with open(filename, 'rb') as handle:
+                    data = cPickle.load(handle)
+                if data.get('version') == self.version:
+                    self.entries = data['entries']
+                    self.extra = data['extra']
+            except (EOFError, ValueError, KeyError, AttributeError, cPickle.UnpicklingError):
+                # A damaged manifest only costs a full rebuild
+                self.entries = collections.OrderedDict()
+                self.extra = {}
+
+    def begin(self, full=True):
+        # A full build keeps only the entries it sees, in the order it sees
+        # them, a partial build starts from everything that was known
+        self.previous = self.entries
+        if full:
+            self.entries = collections.OrderedDict()
+        else:
+            self.entries = collections.OrderedDict(self.previous)
+
+    def get(self, relpath):
+        return self.previous.get(relpath)
+
+    def set(self, relpath, record):
+        self.entries[relpath] = record
+
+    def remove(self, relpath):
+        self.entries.pop(relpath, None)
+
+    def items(self):
+        return self.entries.items()
+
+    def save(self):
+        util.makedirs(os.path.dirname(self.filename))
+
+        data = { 'version': self.version, 'entries': self.entries, 'extra': self.extra }
+
+        tempname = '{0}.{1}.tmp'.format(self.filename, os.getpid())
+        with open(tempname, 'wb') as handle:
+            cPickle.dump(data, handle, cPickle.HIGHEST_PROTOCOL)
+        util.rename(tempname, self.filename)
@@ -0,0 +1,177 @@
+# File:         profiler.py
+# Author:       Brian Allen Vanderburg II
+# Purpose:      Time the phases of building each page
+# License:      Refer to the file license.txt
+
+import os
+import time
+import json
+import threading
+import contextlib
+
+
+# Timings of the page being built by this thread
+_local = threading.local()
+
+
+class Timings(object):
+    def __init__(self):
+        self.phases = {}
+        self.functions = {}
+        self.stylesheet = None
+        self.stack = []
+
+    def enter(self):
+        self.stack.append([time.time(), 0.0])
+
+    def leave(self, name):
+        # Phases record their own time, not that of phases inside them
+        (start, inner) = self.stack.pop()
+        elapsed = time.time() - start
+        self.phases[name] = self.phases.get(name, 0.0) + elapsed - inner
+        if self.stack:
+            self.stack[-1][1] += elapsed
+
+        return elapsed
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['stack'] = []
+        return state
+
+    @property
+    def total(self):
+        return sum(self.phases.values())
+
+
+def begin():
+    _local.timings = Timings()
+    return _local.timings
+
+def end():
+    timings = current()
+    _local.timings = None
+    return timings
+
+def current():
+    return getattr(_local, 'timings', None)
+
+@contextlib.contextmanager
+def phase(name):
+    timings = current()
+    if timings is None:
+        yield
+        return
+
+    timings.enter()
+    try:
+        yield
+    finally:
+        timings.leave(name)
+
+def iterate(name, iterable):
+    # Time spent producing each item counts towards the phase
+    iterator = iter(iterable)
+    while True:
+        with phase(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+def function(name, func):
+    # Wrap an XSLT extension function to record calls and time
+    def wrapper(*args):
+        timings = current()
+        if timings is None:
+            return func(*args)
+
+        timings.enter()
+        try:
+            return func(*args)
+        finally:
+            elapsed = timings.leave('functions')
+            entry = timings.functions.setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed
+
+    return wrapper
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return { 'count': 0, 'total': 0.0 }
+
+    def pick(p):
+        return values[min(len(values) - 1, int(p * len(values)))]
+
+    return {
+        'count': len(values),
+        'total': sum(values),
+        'mean': sum(values) / len(values),
+        'p50': pick(0.50),
+        'p90': pick(0.90),
+        'p99': pick(0.99),
+        'max': values[-1]
+    }
+
+
+class Report(object):
+    def __init__(self, top=20):
+        self.top = top
+        self.start = time.time()
+        self.pages = []
+        self.statuses = {}
+        self.other = {}
+
+    def add(self, relpath, status, timings):
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if timings is not None:
+            self.pages.append((relpath, timings))
+
+    def record(self, name, elapsed):
+        self.other[name] = self.other.get(name, 0.0) + elapsed
+
+    def build(self):
+        phases = {}
+        functions = {}
+        stylesheets = {}
+        for (relpath, timings) in self.pages:
+            for name in timings.phases:
+                phases.setdefault(name, []).append(timings.phases[name])
+
+            for name in timings.functions:
+                entry = functions.setdefault(name, { 'calls': 0, 'total': 0.0 })
+                entry['calls'] += timings.functions[name][0]
+                entry['total'] += timings.functions[name][1]
+
+            if timings.stylesheet:
+                entry = stylesheets.setdefault(timings.stylesheet, { 'stylesheet': timings.stylesheet, 'pages': 0, 'xslt': 0.0, 'total': 0.0 })
+                entry['pages'] += 1
+                entry['xslt'] += timings.phases.get('xslt', 0.0) + timings.phases.get('functions', 0.0)
+                entry['total'] += timings.total
+
+        slowest = sorted(self.pages, key=lambda page: page[1].total, reverse=True)[:self.top]
+
+        return {
+            'elapsed': time.time() - self.start,
+            'statuses': self.statuses,
+            'pages': percentiles([timings.total for (relpath, timings) in self.pages]),
+            'phases': dict((name, percentiles(phases[name])) for name in phases),
+            'functions': functions,
+            'other': self.other,
+            'slowest': [{
+                'relpath': relpath.replace(os.sep, '/'),
+                'stylesheet': timings.stylesheet,
+                'total': timings.total,
+                'phases': timings.phases
+            } for (relpath, timings) in slowest],
+            'stylesheets': sorted(stylesheets.values(), key=lambda entry: entry['total'], reverse=True)[:self.top]
+        }
+
+    def save(self, filename):
+        with open(filename, 'wb') as handle:
+            json.dump(self.build(), handle, indent=2, sort_keys=True)
+            handle.write('\n')
@@ -0,0 +1,177 @@
+# File:         reporter.py
+# Author:       Brian Allen Vanderburg II
+# Purpose:      Report progress without holding up the build
+# License:      Refer to the file license.txt
+
+import sys
+import time
+import json
+import threading
+import collections
+import Queue
+
+
+# Writes to a stream from a background thread, in batches
+class Writer(object):
+    def __init__(self, stream):
+        self.stream = stream
+        self.queue = Queue.Queue()
+
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def write(self, text):
+        self.queue.put(text)
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while True:
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+
+            try:
+                self.stream.write(''.join(batch))
+                self.stream.flush()
+            except (IOError, ValueError):
+                pass
+
+            for i in batch:
+                self.queue.task_done()
+
+    def flush(self):
+        self.queue.join()
+
+
+# The classic output, one line per page with its status
+class Reporter(object):
+    def __init__(self, writer):
+        self.writer = writer
+        self.size = 0
+
+    def message(self, m):
+        self.writer.write(m)
+        self.size = len(m)
+
+    def status(self, s):
+        if self.size > 0:
+            self.writer.write('.' * (80 - self.size - len(s) - 4) + '[ ' + s + ' ]\n')
+            self.size = 0
+
+    def log(self, m):
+        self.writer.write(m + '\n')
+
+    def error(self, text):
+        if self.size > 0:
+            self.writer.write('\n')
+            self.size = 0
+        self.writer.write(text)
+
+    def close(self):
+        self.writer.flush()
+
+
+# Only errors
+class QuietReporter(Reporter):
+    def message(self, m):
+        pass
+
+    def status(self, s):
+        pass
+
+    def log(self, m):
+        pass
+
+    def error(self, text):
+        self.writer.write(text)
+
+
+# A single line with counts of each status, redrawn now and then
+class TtyReporter(Reporter):
+    interval = 0.1
+    width = 79
+
+    def __init__(self, writer):
+        Reporter.__init__(self, writer)
+        self.current = ''
+        self.counts = collections.OrderedDict()
+        self.total = 0
+        self.drawn = 0
+
+    def message(self, m):
+        self.current = m
+
+    def status(self, s):
+        self.counts[s] = self.counts.get(s, 0) + 1
+        self.total += 1
+
+        now = time.time()
+        if now - self.drawn >= self.interval:
+            self.draw()
+            self.drawn = now
+
+    def draw(self):
+        counts = ' '.join('{0} {1}'.format(name, self.counts[name]) for name in self.counts)
+        line = '[{0}] {1} | {2}'.format(self.total, counts, self.current)
+        self.writer.write('\r' + line[:self.width] + '\x1b[K')
+
+    def clear(self):
+        if self.total:
+            self.writer.write('\r\x1b[K')
+
+    def log(self, m):
+        self.clear()
+        self.writer.write(m + '\n')
+        if self.total:
+            self.draw()
+
+    def error(self, text):
+        self.clear()
+        self.writer.write(self.current + '\n' + text)
+        self.current = ''
+
+    def close(self):
+        if self.total:
+            self.draw()
+            self.writer.write('\n')
+        Reporter.close(self)
+
+
+# One JSON object per line for other programs to read
+class JsonReporter(Reporter):
+    def __init__(self, writer):
+        Reporter.__init__(self, writer)
+        self.current = None
+
+    def emit(self, **entry):
+        entry['time'] = time.time()
+        self.writer.write(json.dumps(entry, sort_keys=True) + '\n')
+
+    def message(self, m):
+        self.current = m
+
+    def status(self, s):
+        if self.current is not None:
+            self.emit(event='status', message=self.current, status=s)
+            self.current = None
+
+    def log(self, m):
+        self.emit(event='log', message=m)
+
+    def error(self, text):
+        self.emit(event='error', message=self.current, error=text.rstrip('\n'))
+        self.current = None
+
+
+reporters = collections.OrderedDict([
+    ('classic', Reporter),
+    ('tty', TtyReporter),
+    ('quiet', QuietReporter),
+    ('json', JsonReporter)
+])
+
+def create(name, stream=None):
+    return reporters[name](Writer(stream or sys.stderr))
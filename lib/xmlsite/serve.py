@@ -0,0 +1,291 @@
+# File:         serve.py
+# Author:       Brian Allen Vanderburg II
+# Purpose:      Serve pages over HTTP, building them as they are requested
+# License:      Refer to the file license.txt
+
+import os
+import posixpath
+import urllib
+import urlparse
+import mimetypes
+import threading
+import collections
+import Queue
+import BaseHTTPServer
+
+from lxml import etree
+
+from . import util
+from . import setup
+from . import manifest
+from .config import Config
+from .builder import Builder
+
+
+class Site(object):
+    def __init__(self, config):
+        # Pages and state are built one at a time, the builder and its
+        # caches are not safe to share between threads
+        self.lock = threading.Lock()
+        self.load(config)
+
+    def load(self, config):
+        self.config = config
+        self.builder = config.builder()
+        self.stamps = manifest.stamps(self.builder.files)
+
+        # Start from the states of the last build, but never save them
+        self.builder.manifest = manifest.Manifest(self.builder.manifestname())
+        self.builder.manifest.begin(False)
+        self.builder.manifest.extra.pop('snapshot', None)
+
+        # Built pages by target and states by source, with what they were
+        # built from
+        self.pages = {}
+        self.states = collections.OrderedDict()
+        self.statefiles = None
+
+        # State files are served from where they would be saved
+        opts = config.opts
+        self.stateprefix = None
+        if not opts.statedir is None:
+            relpath = os.path.relpath(opts.statedir, opts.outdir)
+            if relpath.startswith(os.pardir):
+                relpath = 'state'
+            self.stateprefix = relpath.replace(os.sep, '/').strip('/') + '/'
+
+    def refresh(self):
+        # The configuration, header or footer changed
+        if manifest.changed(self.stamps):
+            config = Config(self.config.opts)
+            setup.setup(config)
+            self.load(config)
+
+        # Check stylesheets against their files again
+        Builder._verified.clear()
+
+    def get(self, path):
+        # Returns the content of a path and its type, or None if not found
+        with self.lock:
+            self.refresh()
+
+            if self.stateprefix is not None and path.startswith(self.stateprefix):
+                content = self.state(path[len(self.stateprefix):])
+                if content is not None:
+                    return (content, 'application/xml')
+
+            page = self.find(path)
+            if page is not None:
+                content = self.page(page)
+                if content is not None:
+                    return (content, mimetypes.guess_type(page.targetfile)[0] or 'text/html')
+
+        return self.static(path)
+
+    def find(self, path):
+        # The page whose target is the requested path
+        builder = self.builder
+        if not path.endswith(builder.extension):
+            return None
+
+        relbase = path[:-len(builder.extension)].replace('/', os.sep)
+        for ending in builder.endings:
+            relpath = relbase + ending
+            if not os.path.isfile(os.path.join(self.config.opts.indir, relpath)):
+                continue
+            if not builder.selected(relpath):
+                continue
+
+            page = builder.target(relpath)
+            if page is not None and page.reldest.replace(os.sep, '/') == path:
+                return page
+
+        return None
+
+    def page(self, page):
+        entry = self.pages.get(page.relpath)
+        if entry is not None and entry[1] == page.phash and not manifest.changed(entry[0]):
+            return entry[2]
+
+        (deps, content) = self.build(page)
+        self.pages[page.relpath] = (deps, page.phash, content)
+        return content
+
+    def build(self, page):
+        builder = self.builder
+
+        # The state comes along for free
+        (inxml, sources) = self.parse(page)
+        self.states[page.relpath] = (manifest.stamps(sources), builder.buildstate(inxml))
+        self.statefiles = None
+
+        deps = set(sources)
+        result = builder.buildxml(inxml, page.params, deps)
+        if result is None:
+            return (manifest.stamps(deps), None)
+
+        output = etree.tostring(result, pretty_print=True)
+        content = builder.cleanup(output, page.params).encode(builder.encoding)
+
+        return (manifest.stamps(deps), content)
+
+    def state(self, filename):
+        self.update()
+
+        entry = self.statefiles.get(filename)
+        if entry is None:
+            return None
+
+        if entry[1] is None:
+            entry[1] = Builder.serialize(entry[0]())
+
+        return entry[1]
+
+    def update(self):
+        # Bring the states of every page up to date, in walk order
+        builder = self.builder
+        sourceroot = self.config.opts.indir
+
+        states = collections.OrderedDict()
+        for (reldir, files, trusted) in builder.walk(sourceroot, excluded=builder.excludeddirs):
+            for f in files:
+                relpath = os.path.join(reldir, f)
+                if not builder.selected(relpath):
+                    continue
+
+                page = builder.target(relpath)
+                if page is None or page.sourcefile == page.targetfile:
+                    continue
+
+                entry = self.states.get(relpath)
+                if entry is None or manifest.changed(entry[0]):
+                    if page.record is not None:
+                        entry = (page.record['sources'], page.record['states'])
+                    else:
+                        (inxml, sources) = self.parse(page)
+                        entry = (manifest.stamps(sources), builder.buildstate(inxml))
+                    self.statefiles = None
+
+                states[relpath] = entry
+
+        if len(states) != len(self.states):
+            self.statefiles = None
+        self.states = states
+
+        if self.statefiles is None:
+            entries = []
+            for (relpath, entry) in self.states.items():
+                entries.extend([(relpath, i) for i in entry[1]])
+
+            # Files are built when first asked for
+            self.statefiles = {}
+            for (filename, digest, build) in builder.statefiles(entries):
+                self.statefiles[filename.replace(os.sep, '/')] = [build, None]
+
+    def parse(self, page):
+        # Returns the document and the files it was read from
+        (inxml, sources) = self.builder.parse(page.sourcefile)
+        sources.add(page.sourcefile)
+        sources.update(self.builder.files)
+
+        return (inxml, sources)
+
+    def static(self, path):
+        # Other files come from the input, as if linked, or the output,
+        # but hidden files and the cache are never served
+        if any(part.startswith('.') for part in path.split('/')):
+            return None
+
+        relpath = path.replace('/', os.sep)
+        filename = os.path.join(self.config.opts.indir, relpath)
+        if not (os.path.isfile(filename) and self.builder.selected(relpath)):
+            filename = os.path.join(self.config.opts.outdir, relpath)
+            if not os.path.isfile(filename):
+                return None
+
+        cachedir = self.config.opts.cachedir
+        if not cachedir is None and filename.startswith(os.path.join(cachedir, '')):
+            return None
+
+        with open(filename, 'rb') as handle:
+            content = handle.read()
+
+        return (content, mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        util.log('{0} - {1}'.format(self.client_address[0], format % args))
+
+    def do_GET(self):
+        self.respond(True)
+
+    def do_HEAD(self):
+        self.respond(False)
+
+    def respond(self, body):
+        path = urllib.unquote(urlparse.urlsplit(self.path).path)
+
+        # Stay within the site
+        path = posixpath.normpath('/' + path) + ('/' if path.endswith('/') else '')
+        path = path.lstrip('/')
+        if path == '' or path.endswith('/'):
+            path += 'index' + self.server.site.builder.extension
+
+        try:
+            result = self.server.site.get(path)
+        except (etree.Error, OSError, IOError, ValueError, util.Error) as e:
+            self.send(500, util.errortext(e), 'text/plain', body)
+            return
+
+        if result is None:
+            self.send(404, 'Not found: ' + path + '\n', 'text/plain', body)
+        else:
+            self.send(200, result[0], result[1], body)
+
+    def send(self, code, content, type, body):
+        self.send_response(code)
+        self.send_header('Content-Type', type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if body:
+            self.wfile.write(content)
+
+
+class _Server(BaseHTTPServer.HTTPServer):
+    # Requests are handled by a fixed number of threads
+    def __init__(self, address, site, threads):
+        BaseHTTPServer.HTTPServer.__init__(self, address, _Handler)
+        self.site = site
+        self.requests = Queue.Queue(threads * 4)
+
+        for i in range(threads):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def work(self):
+        while True:
+            (request, client_address) = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+
+def run(config):
+    opts = config.opts
+    server = _Server((opts.bind, opts.port), Site(config), opts.threads)
+
+    util.log('Serving on http://{0}:{1}/'.format(opts.bind, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
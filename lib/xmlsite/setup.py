@@ -4,40 +4,17 @@
 # License:      Refer to the file license.txt
 
 import os
+import hashlib
+import threading
+import collections
 
 from . import util
+from . import manifest
+from . import profiler
 
 from lxml import etree
 
 # Set up some custom xsl/xpath functions
-def base_uri(context, node=None):
-    base = node[0].base if node else context.context_node.base
-    return base.replace(os.sep, '/')
-
-def rbase_uri(context, node=None):
-    node = node[0] if node else context.context_node
-    base = node.base
-    pbase = base
-
-    parent = node.getparent()
-    while parent is not None:
-        pbase = parent.base
-        parent = parent.getparent()
-
-    base = base.replace('/', os.sep)
-    pbase = pbase.replace('/', os.sep)
-
-
-    rbase = os.path.relpath(base, os.path.dirname(pbase))
-    rbase = rbase.replace(os.sep, '/')
-
-    # If base is /path/to/something/, relpath will strip out the trailing '/'
-    # But we need to keep it as it is a directory and not a file
-    if base.endswith(os.sep) and not rbase.endwith('/'):
-        rbase = rbase + '/'
-
-    return rbase
-
 def dirname(context, base):
     pos = base.rfind('/')
     return base[:pos + 1] if pos >= 0 else ""
@@ -46,47 +23,190 @@ def basename(context, base):
     pos = base.rfind('/')
     return base[pos + 1:] if pos >= 0 else base
 
+# Files read by the functions, kept for each thread so that the builder
+# can add them to the dependencies of the transform it just ran
+_reads = threading.local()
+
+def readfiles():
+    # Returns and forgets the files read in this thread
+    files = getattr(_reads, 'files', set())
+    _reads.files = set()
+    return files
+
+def readfile(filename):
+    if not hasattr(_reads, 'files'):
+        _reads.files = set()
+    _reads.files.add(os.path.abspath(filename))
+
 # Syntax highlighting
-def highlight_code(context, code, syntax):
-    import pygments
-    import pygments.formatters
-    import pygments.lexers
+class Highlighter(object):
+    def __init__(self, config):
+        # Options
+        self.nowrap = not util.getbool(config.property('highlight.wrap', 'no'))
+        self.noclasses = not util.getbool(config.property('highlight.classes', 'yes'))
+        self.nobackground = not util.getbool(config.property('highlight.background', 'no'))
+        self.cssclass = config.property('highlight.cssclass', 'highlight')
+        self.size = int(config.property('highlight.cachesize', '1000'))
+
+        # Results are kept on disk, one file each, so parallel workers can
+        # share them, and separated by the options they were made with
+        options = repr((self.nowrap, self.noclasses, self.nobackground, self.cssclass))
+        self.cachedir = os.path.join(config.opts.cachedir, 'highlight', hashlib.md5(options).hexdigest())
+
+        self.formatter = None
+        self.lexers = {}
+        self.results = collections.OrderedDict()
+        self.files = {}
+
+        # Transforms may run at the same time in several threads
+        self.lock = threading.Lock()
+
+    def highlight(self, code, syntax):
+        data = code.encode('utf-8') if isinstance(code, unicode) else code
+        key = hashlib.sha1(syntax.encode('utf-8') + '\0' + data).hexdigest()
+
+        # Most recently used results are kept in memory
+        with self.lock:
+            result = self.results.pop(key, None)
+        if result is None:
+            result = self.load(key)
+        if result is None:
+            result = self.format(code, syntax)
+            self.save(key, result)
+
+        with self.lock:
+            self.results[key] = result
+            if len(self.results) > self.size:
+                self.results.popitem(False)
+
+        return result
+
+    def format(self, code, syntax):
+        import pygments
+        import pygments.formatters
+        import pygments.lexers
+
+        if self.formatter is None:
+            self.formatter = pygments.formatters.HtmlFormatter(nowrap=self.nowrap,
+                                                               cssclass=self.cssclass,
+                                                               noclasses=self.noclasses,
+                                                               nobackground=self.nobackground)
+
+        lexer = self.lexers.get(syntax)
+        if lexer is None:
+            lexer = self.lexers[syntax] = pygments.lexers.get_lexer_by_name(syntax, stripall=True)
+
+        return pygments.highlight(code, lexer, self.formatter)
+
+    def path(self, key):
+        return os.path.join(self.cachedir, key[:2], key[2:])
+
+    def load(self, key):
+        try:
+            with open(self.path(key), 'rb') as handle:
+                return handle.read().decode('utf-8')
+        except IOError:
+            return None
+
+    def save(self, key, result):
+        filename = self.path(key)
+        util.makedirs(os.path.dirname(filename))
+
+        tempname = '{0}.{1}.tmp'.format(filename, os.getpid())
+        with open(tempname, 'wb') as handle:
+            handle.write(result.encode('utf-8'))
+        util.rename(tempname, filename)
+
+    def read(self, filename):
+        # Source files are only read again when they change
+        stamp = manifest.stamp(filename)
+        entry = self.files.get(filename)
+        if entry is None or entry[0] != stamp:
+            entry = self.files[filename] = (stamp, file(filename, "rU").read())
+
+        return entry[1]
+
+
+# The functions that need more than their arguments, bound to the
+# configuration they were set up for
+class Functions(object):
+    def __init__(self, config):
+        self.highlighter = Highlighter(config)
+
+    @staticmethod
+    def cache(context, name):
+        # Results kept for a single transform, each transform has its own
+        return context.eval_context.setdefault(name, {})
+
+    def base_uri(self, context, node=None):
+        base = node[0].base if node else context.context_node.base
+
+        cache = self.cache(context, 'base-uri')
+        result = cache.get(base)
+        if result is None:
+            result = cache[base] = base.replace(os.sep, '/')
+
+        return result
+
+    def rbase_uri(self, context, node=None):
+        node = node[0] if node else context.context_node
+        base = node.base
+
+        # The base of the document the node is in
+        roots = self.cache(context, 'roots')
+        root = node.getroottree().getroot()
+        pbase = roots.get(root)
+        if pbase is None:
+            pbase = roots[root] = root.base if root is not None else base
 
-    global _config
+        cache = self.cache(context, 'rbase-uri')
+        result = cache.get((base, pbase))
+        if result is None:
+            result = cache[(base, pbase)] = self.relative(base, pbase)
 
-    # Options
-    nowrap = not util.getbool(_config.property('highlight.wrap', 'no'))
-    noclasses = not util.getbool(_config.property('highlight.classes', 'yes'))
-    nobackground = not util.getbool(_config.property('highlight.background', 'no'))
-    cssclass = _config.property('highlight.cssclass', 'highlight')
+        return result
+
+    @staticmethod
+    def relative(base, pbase):
+        base = base.replace('/', os.sep)
+        pbase = pbase.replace('/', os.sep)
 
-    lexer = pygments.lexers.get_lexer_by_name(syntax, stripall=True)
-    formatter = pygments.formatters.HtmlFormatter(nowrap=nowrap,
-                                                  cssclass=cssclass,
-                                                  noclasses=noclasses,
-                                                  nobackground=nobackground)
-    result = pygments.highlight(code, lexer, formatter)
+        rbase = os.path.relpath(base, os.path.dirname(pbase))
+        rbase = rbase.replace(os.sep, '/')
 
-    return result
+        # If base is /path/to/something/, relpath will strip out the trailing '/'
+        # But we need to keep it as it is a directory and not a file
+        if base.endswith(os.sep) and not rbase.endswith('/'):
+            rbase = rbase + '/'
 
-def highlight_file(context, filename, syntax):
-    return highlight_code(context, file(filename, "rU").read(), syntax)
+        return rbase
+
+    def highlight_code(self, context, code, syntax):
+        return self.highlighter.highlight(code, syntax)
+
+    def highlight_file(self, context, filename, syntax):
+        readfile(filename)
+        return self.highlighter.highlight(self.highlighter.read(filename), syntax)
 
 
 # Add custom functions
 def setup(config):
-    # TODO: find a way that doesn't require storing global
-    # (Can we pass a config reference in the context?)
-    global _config
-    _config = config
+    bound = Functions(config)
 
-    ns = etree.FunctionNamespace('urn:mrbavii:xmlsite')
+    functions = {
+        'base-uri': bound.base_uri,
+        'rbase-uri': bound.rbase_uri,
+        'dirname': dirname,
+        'basename': basename,
 
-    ns['base-uri'] = base_uri
-    ns['rbase-uri'] = rbase_uri
-    ns['dirname'] = dirname
-    ns['basename'] = basename
+        'highlight_code': bound.highlight_code,
+        'highlight_file': bound.highlight_file
+    }
 
-    ns['highlight_code'] = highlight_code
-    ns['highlight_file'] = highlight_file
+    ns = etree.FunctionNamespace('urn:mrbavii:xmlsite')
+    for name in functions:
+        if config.opts.profile:
+            ns[name] = profiler.function(name, functions[name])
+        else:
+            ns[name] = functions[name]
 
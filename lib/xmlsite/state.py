@@ -3,11 +3,23 @@
 # Purpose:      The state object extracts state from a document.
 # License:      Refer to the file license.txt
 
+import re
+import operator
 from copy import deepcopy
 
 from lxml import etree
 
+# Tags are shared by every entry that has them
+_tags = {}
+
+def _intern(tag):
+    return _tags.setdefault(tag, tag)
+
+
 class _State(object):
+    # There can be very many of these, so they are kept small
+    __slots__ = ('bookmark', 'year', 'month', 'day', 'title', 'summary', 'tags', 'key')
+
     def __init__(self):
         self.bookmark = None
         self.year = None
@@ -16,24 +28,60 @@ class _State(object):
         self.title = None
         self.summary = None
         self.tags = []
+        self.key = None
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for (name, value) in zip(self.__slots__, state):
+            setattr(self, name, value)
+        self.tags = [_intern(tag) for tag in self.tags]
+
+    def dump(self):
+        # The fields as plain data, for the state dumps of sharded builds
+        return dict((name, getattr(self, name)) for name in StateParser.fields + ('tags',))
+
+    @staticmethod
+    def load(data):
+        state = _State()
+        for name in StateParser.fields:
+            setattr(state, name, data[name])
+        state.tags = [_intern(tag) for tag in data['tags']]
+        state.finish()
+        return state
 
     @property
     def valid(self):
         return bool(self.year and self.month and self.day and self.title and self.summary)
 
-    def __cmp__(self, other):
-        v = int(self.year) - int(other.year)
-        if v != 0:
-            return v
-        
-        v = int(self.month) - int(other.month)
-        if v != 0:
-            return v
+    def finish(self):
+        # The date packed into one number that sorts the same way, computed
+        # once rather than on every comparison
+        try:
+            self.key = (int(self.year) << 32) + (int(self.month) << 16) + int(self.day)
+        except ValueError:
+            raise ValueError('Invalid state date: {0}-{1}-{2}'.format(self.year, self.month, self.day))
 
-        return int(self.day) - int(other.day)
+    def __cmp__(self, other):
+        return cmp(self.key, other.key)
 
 
 class StateParser(object):
+    # Fields holding a single value, the tags may have many
+    fields = ('bookmark', 'year', 'month', 'day', 'title', 'summary')
+
+    # A plain attribute of the entry can be read without XPath
+    attribute = re.compile(r'^\s*@([a-zA-Z_][a-zA-Z0-9_.-]*)\s*$')
+
+    # Entries found by a path of element names from the root, with fields
+    # that only look inside the entry, can be read as the document is parsed
+    path = re.compile(r'^\s*((/[a-zA-Z_][a-zA-Z0-9_.-]*(:[a-zA-Z_][a-zA-Z0-9_.-]*)?)+)\s*$')
+    outside = re.compile(r'(^|[(,=<>|+\s])/|\.\.|::|\b(id|key|document|current)\s*\(')
+
+    # Included content is only there once the whole document is parsed
+    xinclude = '{http://www.w3.org/2001/XInclude}include'
+
     def __init__(self, config, xml):
         self.config = config
 
@@ -46,62 +94,180 @@ class StateParser(object):
         self.summary = xml.get('summary')
         self.tag = xml.get('tag')
 
+        self.compile()
+
+    def __getstate__(self):
+        # Compiled expressions can't be pickled, they are compiled again
+        state = self.__dict__.copy()
+        del state['entryxpath']
+        del state['getters']
+        del state['tagxpath']
+        del state['steps']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.compile()
+
+    def compile(self):
+        ns = self.config.namespaces()
+
+        # Undefined prefixes are only found when an expression is evaluated,
+        # so each is tried once on an empty element
+        dummy = etree.Element('dummy')
+
+        def xpath(name, expr):
+            try:
+                result = etree.XPath(expr, namespaces=ns)
+                result(dummy)
+            except etree.XPathSyntaxError as e:
+                raise ValueError('Invalid state {0} expression: {1}: {2}'.format(name, expr, e))
+            except etree.XPathEvalError as e:
+                # The site functions may not be set up yet
+                if str(e) != 'Unregistered function':
+                    raise ValueError('Invalid state {0} expression: {1}: {2}'.format(name, expr, e))
+
+            return result
+
+        self.entryxpath = xpath('entry', self.entry) if self.entry else None
+        self.tagxpath = xpath('tag', self.tag) if self.tag else None
+
+        # Each field is read by a function returning the value or None
+        self.getters = []
+        for name in self.fields:
+            expr = getattr(self, name)
+            if not expr:
+                continue
+
+            match = self.attribute.match(expr)
+            if match:
+                getter = operator.methodcaller('get', match.group(1))
+            else:
+                getter = self.first(xpath(name, expr))
+
+            self.getters.append((name, getter))
+
+        self.steps = self.compilesteps(ns)
+
+    def compilesteps(self, ns):
+        # The element names along the entry path, or None if entries can
+        # not be read while parsing
+        match = self.path.match(self.entry or '')
+        if not match:
+            return None
+
+        for expr in [getattr(self, name) for name in self.fields] + [self.tag]:
+            if expr and not self.attribute.match(expr) and self.outside.search(expr):
+                return None
+
+        steps = []
+        for step in match.group(1).split('/')[1:]:
+            parts = step.split(':', 1)
+            if len(parts) == 1:
+                steps.append(parts[0])
+            elif parts[0] in ns:
+                steps.append('{' + ns[parts[0]] + '}' + parts[1])
+            else:
+                raise ValueError('Invalid state entry expression: {0}: Undefined namespace prefix {1}'.format(self.entry, parts[0]))
+
+        return steps
+
+    @staticmethod
+    def first(xpath):
+        def getter(entry):
+            result = xpath(entry)
+            if result:
+                return '' + result[0]
+            return None
+
+        return getter
+
     @staticmethod
     def load(config, xml):
         return StateParser(config, xml)
 
     def execute(self, xml):
-        ns = self.config.namespaces()
-
-        if self.entry:
-            entries = xml.xpath(self.entry, namespaces=ns)
+        if self.entryxpath:
+            entries = self.entryxpath(xml)
         else:
-            entries = [xml]
+            entries = [xml.getroot()]
 
         states = []
         for entry in entries:
-            state = _State()
-
-            if self.bookmark:
-                bookmark = entry.xpath(self.bookmark, namespaces=ns)
-                if bookmark:
-                    state.bookmark = '' + bookmark[0]
-
-            if self.year:
-                year = entry.xpath(self.year, namespaces=ns)
-                if year:
-                    state.year = '' + year[0]
-
-            if self.month:
-                month = entry.xpath(self.month, namespaces=ns)
-                if month:
-                    state.month = '' + month[0]
-
-            if self.day:
-                day = entry.xpath(self.day, namespaces=ns)
-                if day:
-                    state.day = '' + day[0]
-
-            if self.title:
-                title = entry.xpath(self.title, namespaces=ns)
-                if title:
-                    state.title = '' + title[0]
-
-            if self.summary:
-                summary = entry.xpath(self.summary, namespaces=ns)
-                if summary:
-                    state.summary = '' + summary[0]
-
-            if self.tag:
-                tags = entry.xpath(self.tag, namespaces=ns)
-                for tag in tags:
-                    value = '' + tag
-                    value = value.lower()
-                    if value and not value in state.tags:
-                        state.tags.append('' + tag)
-
-            if state.valid:
+            state = self.extract(entry)
+            if state is not None:
                 states.append(state)
 
         return states
-    
+
+    def stream(self, source):
+        # Reads the entries while parsing, freeing each part of the document
+        # once it has been read, returns None if the whole document is needed
+        steps = self.steps
+        events = etree.iterparse(source, events=('start', 'end'), tag=set(steps + [self.xinclude]))
+
+        states = []
+        for (event, elem) in events:
+            if event == 'start':
+                if elem.tag == self.xinclude:
+                    return None
+                continue
+
+            # Elements within an entry or off the path are left alone, they
+            # go when the element on the path holding them does
+            depth = self.depth(elem)
+            if depth is None:
+                continue
+
+            if depth == len(steps):
+                state = self.extract(elem)
+                if state is not None:
+                    states.append(state)
+
+            elem.clear()
+            parent = elem.getparent()
+            if parent is not None:
+                while elem.getprevious() is not None:
+                    del parent[0]
+
+        return states
+
+    def depth(self, elem):
+        # How far along the entry path an element is, or None if not on it
+        steps = self.steps
+        chain = []
+        while elem is not None:
+            if len(chain) == len(steps):
+                return None
+            chain.append(elem.tag)
+            elem = elem.getparent()
+
+        chain.reverse()
+        if chain != steps[:len(chain)]:
+            return None
+
+        return len(chain)
+
+    def extract(self, entry):
+        # The state of an entry, or None if it isn't complete
+        state = _State()
+
+        for (name, getter) in self.getters:
+            value = getter(entry)
+            if value is not None:
+                setattr(state, name, value)
+
+        if self.tagxpath:
+            seen = set()
+            for tag in self.tagxpath(entry):
+                value = '' + tag
+                folded = value.lower()
+                if folded and not folded in seen:
+                    seen.add(folded)
+                    state.tags.append(_intern(value))
+
+        if not state.valid:
+            return None
+
+        state.finish()
+        return state
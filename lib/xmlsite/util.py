@@ -4,52 +4,101 @@
 # License:      Refer to the file license.txt
 
 import sys
+import os
+import re
+import atexit
 
 from lxml import etree
 
+from . import reporter
+
 # Basic error class
 class Error(Exception):
     pass
 
-# Output related functions
-_size = 0
+# Output related functions, written by the reporter in the background
+_reporter = None
+
+def setreporter(name):
+    global _reporter
+    if _reporter is not None:
+        _reporter.close()
+    _reporter = reporter.create(name)
+
+def getreporter():
+    if _reporter is None:
+        setreporter('classic')
+
+    return _reporter
+
+# Anything still waiting is written before exiting
+@atexit.register
+def closereporter():
+    if _reporter is not None:
+        _reporter.close()
 
 def output(s):
-    sys.stderr.write(s)
-    sys.stderr.flush()
+    getreporter().writer.write(s)
 
 def log(m):
-    output(m + '\n')
+    getreporter().log(m)
 
 def message(m):
-    global _size
-
-    output(m)
-    _size = len(m)
+    getreporter().message(m)
 
 def status(s):
-    global _size
-    if _size > 0:
-        output('.' * (80 - _size - len(s) - 4))
-        output('[ ' + s + ' ]\n')
-        _size = 0
+    getreporter().status(s)
 
 def error(e, abort=True):
-    global _size
-    if _size > 0:
-        output('\n')
-        _size = 0
+    getreporter().error(errortext(e))
+
+    if abort:
+        sys.exit(-1)
 
+def errortext(e):
     if isinstance(e, etree.Error):
         result = ''
         for entry in e.error_log:
             result += '[' + str(entry.filename) + ', ' + str(entry.line) + ', ' + str(entry.column) + '] ' + entry.message + '\n'
-        output(result)
+        return result
     else:
-        output(str(e) + '\n')
+        return str(e) + '\n'
 
-    if abort:
-        sys.exit(-1)
+# Compile a list of patterns into one search function, None if there are none
+def searcher(patterns):
+    compiled = [re.compile(i) for i in patterns]
+    if len(compiled) == 0:
+        return None
+    if len(compiled) == 1:
+        return compiled[0].search
+
+    # Combining patterns would renumber their groups and spread inline flags
+    # to the others, so only plain patterns are merged into one
+    if not any(i.groups or i.flags for i in compiled):
+        return re.compile('|'.join('(?:' + i + ')' for i in patterns)).search
+
+    def search(value):
+        for i in compiled:
+            if i.search(value):
+                return True
+        return False
+
+    return search
+
+# Create a directory, which another process may be creating at the same time
+def makedirs(path):
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+# Replace a file with another, os.rename will not overwrite on Windows
+def rename(src, dst):
+    if os.name == 'nt' and os.path.exists(dst):
+        os.unlink(dst)
+    os.rename(src, dst)
 
 # Test if a value it true or not
 def getbool(b):
@@ -0,0 +1,116 @@
+# File:         watch.py
+# Author:       Brian Allen Vanderburg II
+# Purpose:      Rebuild as the input changes
+# License:      Refer to the file license.txt
+
+import os
+import time
+
+from lxml import etree
+
+from . import util
+from . import setup
+from . import manifest
+from .config import Config
+from .builder import Builder
+
+
+# How often to look for changes, in seconds
+INTERVAL = 0.05
+
+
+class Watcher(object):
+    def __init__(self, root, ignore=(), excluded=None):
+        self.root = root
+        self.ignore = set(ignore)
+        self.excluded = excluded
+        self.stamps = {}
+
+    def snapshot(self, files):
+        stamps = {}
+        for (dir, dirs, names) in os.walk(self.root):
+            # Don't watch our own output when it is inside the input
+            dirs[:] = [i for i in dirs if not os.path.join(dir, i) in self.ignore]
+
+            # Nor directories no page can come from, the files used from
+            # them are watched as dependencies
+            if self.excluded:
+                compare = os.path.relpath(dir, self.root).replace(os.sep, '/')
+                compare = compare + '/' if compare != '.' else ''
+                dirs[:] = [i for i in dirs if not self.excluded(compare + i + '/')]
+
+            for name in names:
+                path = os.path.join(dir, name)
+                stamps[path] = manifest.stamp(path)
+
+        for path in files:
+            if not path in stamps:
+                stamps[path] = manifest.stamp(path)
+
+        return stamps
+
+    def start(self, files):
+        self.stamps = self.snapshot(files)
+
+    def poll(self, files):
+        stamps = self.snapshot(files)
+
+        changed = set()
+        for path in stamps:
+            if self.stamps.get(path) != stamps[path]:
+                changed.add(path)
+        for path in self.stamps:
+            if not path in stamps:
+                changed.add(path)
+
+        self.stamps = stamps
+        return changed
+
+
+def dependencies(config):
+    files = set()
+    for builder in config.selected():
+        files.update(builder.dependencies())
+
+    return files
+
+def excluded(config):
+    # Only directories that every builder excludes are skipped
+    builders = config.selected()
+    if all(builder.excludeddirs for builder in builders):
+        return lambda compare: all(builder.excludeddirs(compare) for builder in builders)
+
+    return None
+
+def run(config):
+    opts = config.opts
+    files = dependencies(config)
+
+    watcher = Watcher(opts.indir, (opts.outdir, opts.cachedir), excluded(config))
+    watcher.start(files)
+
+    util.log('Watching for changes')
+    try:
+        while True:
+            time.sleep(INTERVAL)
+
+            changed = watcher.poll(files)
+            if not changed:
+                continue
+
+            try:
+                Builder.invalidate(changed)
+                if any(changed & set(builder.files) for builder in config.selected()):
+                    # The configuration, header or footer changed
+                    config = Config(opts)
+                    setup.setup(config)
+                    config.execute()
+                else:
+                    config.execute(changed)
+            except (etree.Error, OSError, IOError, ValueError, util.Error) as e:
+                util.error(e, False)
+
+            files = dependencies(config)
+            watcher.excluded = excluded(config)
+    except KeyboardInterrupt:
+        pass